@@ -1,18 +1,54 @@
+from __future__ import annotations
+
+import argparse
 import functools
+import hashlib
+import importlib
+import json
 import logging
+import os
+import pickle
+import re
+import shutil
+import sqlite3
+import tempfile
 import time
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from multiprocessing.pool import ThreadPool
+from itertools import chain, islice, repeat
 from typing import Union, IO
 
-import pandas as pd
-from fuzzy_pandas import fuzzy_merge
 
-FORMAT = "%(asctime)-15s %(clientip)s %(user)-8s %(message)s"
-logging.basicConfig(format=FORMAT)
+class LazyModule:
+    # numpy and pandas take most of a second to import, so they are loaded on
+    # first use and then put in place of this stand-in; importing the module or
+    # running --help stays cheap
+    def __init__(self, name: str, alias: str):
+        self.name, self.alias = name, alias
+
+    def __getattr__(self, attribute: str):
+        module = importlib.import_module(self.__dict__["name"])
+        globals()[self.__dict__["alias"]] = module
+        return getattr(module, attribute)
+
+
+np = LazyModule("numpy", "np")
+pd = LazyModule("pandas", "pd")
+
+FORMAT = "%(asctime)-15s %(levelname)-8s %(name)s %(message)s"
 logger = logging.getLogger("fuzzy_matching")
 
+NON_ALPHANUMERIC = re.compile(r"[\W_]+")
+# rough scorer working set per left x right pair, used to size chunks
+PAIR_BYTES = 32
+OUTPUT_FORMATS = ("xlsx", "csv", "parquet")
+CASCADE_STAGES = ("exact", "length", "characters")
+COLUMN_SCORERS = ("jaro_winkler", "exact")
+SCORE_COLUMNS = ("similarity_index", "similarity_score", "match_rank")
+BOUND_SLACK = 1e-9
+
 
 def timer(func):
     @functools.wraps(func)
@@ -22,7 +58,7 @@ def timer(func):
         end = time.time()
         lapsed = end - start
         duration = (
-            datetime(1, 1, 1) - timedelta(seconds=lapsed) if lapsed > 60 else lapsed
+            datetime(1, 1, 1) + timedelta(seconds=lapsed) if lapsed > 60 else lapsed
         )
         msg = (
             f"{func.__name__} completed in {duration.hour} hours(s): "
@@ -36,6 +72,54 @@ def timer(func):
     return wrapper
 
 
+class MatchMetrics:
+    # timings and counts per stage of a run (read, normalize, block, score, dedupe,
+    # write); each event also goes to callback, e.g. for a job runner to record.
+    # block and score seconds are summed over chunks, so over workers too
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.events: list = []
+
+    @contextmanager
+    def stage(self, name: str, **counts):
+        # the caller may add counts to the yielded dict before the block ends
+        started = time.perf_counter()
+        yield counts
+        self.record(name, time.perf_counter() - started, **counts)
+
+    def record(self, stage: str, seconds: float, **counts):
+        event = dict(stage=stage, seconds=seconds, **counts)
+        self.events.append(event)
+        logger.debug("%s", event)
+        if self.callback is not None:
+            self.callback(event)
+
+    def totals(self) -> dict:
+        totals: dict = {}
+        for event in self.events:
+            total = totals.setdefault(event["stage"], {"seconds": 0.0, "calls": 0})
+            total["seconds"] += event["seconds"]
+            total["calls"] += 1
+        return totals
+
+    def candidate_pairs(self) -> dict:
+        pairs: dict = defaultdict(int)
+        for event in self.events:
+            if event["stage"] == "score":
+                pairs[event["threshold"]] += event["candidate_pairs"]
+        return dict(pairs)
+
+    def as_dict(self) -> dict:
+        return {
+            "stages": self.totals(),
+            "candidate_pairs": [
+                {"threshold": threshold, "pairs": pairs}
+                for threshold, pairs in self.candidate_pairs().items()
+            ],
+            "events": self.events,
+        }
+
+
 @timer
 class FuzzyMatch:
 
@@ -47,96 +131,1224 @@ class FuzzyMatch:
         *,
         left_df: Union[pd.DataFrame, None, IO, str],
         left_on: Union[str, list],
-        right_df: Union[pd.DataFrame, None, IO, str],
-        right_on: Union[str, list],
+        right_df: Union[pd.DataFrame, None, IO, str] = None,
+        right_on: Union[str, list, None] = None,
         start_threshold: float = 1.0,
         minimum_threshold: float = 0.79,
         master: str = "left",
+        single_pass: bool = False,
+        blocker: Union["Blocker", list, None] = None,
+        scorer: str = "reference",
+        workers: int = 1,
+        chunk_size: Union[int, None] = None,
+        memory_budget: int = 256 * 1024 ** 2,
+        trace: bool = False,
+        stream: bool = False,
+        stream_rows: int = 10_000,
+        top_k: Union[int, None] = None,
+        index_dir: Union[str, None] = None,
+        cache_path: Union[str, None] = None,
+        output_format: Union[str, None] = None,
+        output_columns: Union[list, None] = None,
+        output_rows: int = 100_000,
+        cascade: Union[tuple, list, None] = None,
+        compact: bool = False,
+        dedupe: bool = False,
+        weights: Union[list, None] = None,
+        column_scorers: Union[list, None] = None,
+        excel_cache_dir: Union[str, None] = None,
+        metrics: Union[MatchMetrics, None] = None,
+        spill_dir: Union[str, None] = None,
     ):
+        # a stream is appended to a block at a time, which xlsx cannot take
+        output_format = output_format or ("csv" if stream else "xlsx")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"output_format must be one of {', '.join(OUTPUT_FORMATS)}, "
+                f"not {output_format!r}"
+            )
+        if stream and output_format == "xlsx":
+            raise ValueError("stream writes csv or parquet output, not xlsx")
+        unknown = set(cascade or ()) - set(CASCADE_STAGES)
+        if unknown:
+            raise ValueError(
+                f"cascade stages must be among {', '.join(CASCADE_STAGES)}, "
+                f"not {', '.join(sorted(unknown))}"
+            )
+        self.check_modes(
+            stream=stream, cache_path=cache_path, dedupe=dedupe, top_k=top_k
+        )
+        self.left_columns = as_columns(left_on)
+        self.right_columns = self.left_columns if dedupe else as_columns(right_on)
+        self.composite = (
+            len(self.left_columns) > 1
+            or weights is not None
+            or column_scorers is not None
+        )
+        if self.composite:
+            self.check_composite(
+                weights,
+                column_scorers,
+                top_k=top_k,
+                cache_path=cache_path,
+                dedupe=dedupe,
+                cascade=cascade,
+                compact=compact,
+            )
+            self.weights = self.column_weights(weights)
+            self.column_scorers = list(
+                column_scorers or ["jaro_winkler"] * len(self.left_columns)
+            )
+        if dedupe:
+            # the one list is indexed as the right side and queried against itself
+            right_df, right_on, left_df = left_df, left_on, None
         self.master = master
-        self.right_df = self.get_dataframe(right_df)
+        self.compact = compact
+        self.metrics = metrics or MatchMetrics()
+        self.excel_cache_dir = excel_cache_dir
+        self.spill_dir = spill_dir
+        self.output_columns = output_columns
+        right_read = self.read_columns(self.right_columns)
+        self.match_index = (
+            MatchIndex.load_or_build(
+                index_dir,
+                right_df,
+                right_on,
+                blocker,
+                self.get_dataframe,
+                right_read,
+                self.metrics,
+            )
+            if index_dir
+            else MatchIndex(
+                self.get_dataframe(right_df, right_read),
+                right_on,
+                blocker,
+                self.metrics,
+            )
+        )
+        self.right_df = self.match_index.right_df
+        if compact:
+            self.right_df[right_on] = self.right_df[right_on].astype("category")
+        self.right_keys = self.match_index.right_keys
+        if self.composite:
+            self.right_composite = CompositeKeys(self.match_index.column_keys)
+        self.blocking_index = self.match_index.blocking_index
         self.right_on = right_on
-        self.left_df = self.get_dataframe(left_df)
+        self.left_df = (
+            None
+            if stream or dedupe
+            else self.get_dataframe(left_df, self.read_columns(self.left_columns))
+        )
         self.left_on = left_on
+        if not stream:
+            # a streamed left file is checked a block at a time as it is read
+            self.check_output_columns(self.right_df, self.left_df)
+        self.start_threshold = start_threshold
         self._threshold = start_threshold
         self.minimum_threshold = minimum_threshold
-        self.final_output: list = []
         self.result: Union[pd.DataFrame, None, IO, str] = None
-        self.left_shape = self.left_df.copy().shape[0]
+        self.left_shape = 0 if self.left_df is None else len(self.left_df)
         self.convert_lookup_columns_to_string()
-        with ThreadPoolExecutor(max_workers=100) as executor:
-            executor.submit(self.run_iterations)
+        self.candidate_pairs = 0
+        self.jaro_winkler = JaroWinklerScorer(backend=scorer)
+        self.cascade = tuple(cascade or ())
+        self.workers = workers
+        self.memory_budget = memory_budget
+        self.requested_chunk_size = chunk_size
+        self.chunk_size = chunk_size or self.derive_chunk_size()
+        self.trace = trace
+        self.chunk_trace: list = []
+        self.output_path: Union[str, None] = None
+        self.output_format = output_format
+        self.output_rows = output_rows
+        self.k = top_k
+        self.minimum_score = minimum_threshold
+        self.streaming = stream
+        if stream:
+            self.run_stream(left_df, stream_rows)
+            return
+        if cache_path:
+            self.run_incremental(cache_path)
+            return
+        if dedupe:
+            self.run_dedupe()
+            return
+        self.pool = self.start_pool() if workers > 1 else None
+        try:
+            if top_k:
+                self.run_top_k()
+            elif single_pass:
+                self.run_single_pass()
+            else:
+                self.run_iterations()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
 
-    @staticmethod
-    def get_dataframe(file: Union[pd.DataFrame, None, IO, str]):
-        return (
-            file
-            if isinstance(file, pd.DataFrame)
-            else FileReader(file).data.drop_duplicates()
+    def check_modes(self, **modes):
+        # each of these runs the whole match its own way, so only one can be chosen
+        chosen = [name for name, value in modes.items() if value]
+        if len(chosen) > 1:
+            raise ValueError(f"{' and '.join(chosen)} cannot be combined")
+
+    def check_composite(self, weights, column_scorers, **modes):
+        if len(self.left_columns) != len(self.right_columns):
+            raise ValueError("left_on and right_on must name as many columns")
+        for name, values in (("weights", weights), ("column_scorers", column_scorers)):
+            if values is not None and len(values) != len(self.left_columns):
+                raise ValueError(f"{name} needs one entry per lookup column")
+        unknown = set(column_scorers or ()) - set(COLUMN_SCORERS)
+        if unknown:
+            raise ValueError(
+                f"column_scorers must be among {', '.join(COLUMN_SCORERS)}, "
+                f"not {', '.join(sorted(unknown))}"
+            )
+        unsupported = [name for name, value in modes.items() if value]
+        if unsupported:
+            raise ValueError(
+                f"{', '.join(unsupported)} cannot be combined with weighted "
+                "multi-column matching"
+            )
+
+    def check_output_columns(self, *frames):
+        known = set(SCORE_COLUMNS + ("cluster_id", "cluster_size")).union(
+            *(frame.columns for frame in frames if frame is not None)
+        )
+        unknown = [col for col in self.output_columns or () if col not in known]
+        if unknown:
+            raise ValueError(
+                f"output_columns not found in the input: {', '.join(map(str, unknown))}"
+            )
+
+    def column_weights(self, weights: Union[list, None]) -> np.ndarray:
+        # scaled to sum to 1 so a composite score is on the same 0-1 scale
+        weights = np.asarray(
+            weights or [1.0] * len(self.left_columns), dtype=np.float64
+        )
+        if (weights < 0).any() or weights.sum() <= 0:
+            raise ValueError("weights must be non-negative and not all zero")
+        return weights / weights.sum()
+
+    def derive_chunk_size(self) -> int:
+        # as many left rows as fit in the memory budget when each is paired with
+        # every right row, shared between the chunks in flight on the workers;
+        # it bounds memory only, as every left row is scored against the same
+        # right rows (its own blocking candidates) whatever chunk it lands in;
+        # with workers, chunks are also kept small enough for about four apiece
+        # so that none of them sits idle behind a slow one
+        row_bytes = max(self.right_df.shape[0], 1) * PAIR_BYTES * max(self.workers, 1)
+        rows = min(self.memory_budget // row_bytes, self.left_shape)
+        if self.workers > 1:
+            rows = min(rows, -(-self.left_shape // (self.workers * 4)))
+        return int(max(1, rows))
+
+    def start_pool(self) -> ProcessPoolExecutor:
+        # left_df, right_df and the blocking index travel to each worker once,
+        # chunks are then sent as (start, stop) row bounds
+        state = {
+            key: value
+            for key, value in vars(self).items()
+            if key not in ("pool", "result", "chunk_trace", "metrics")
+        }
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_match_worker,
+            initargs=(state,),
         )
 
-    def run_async(self):
+    def get_dataframe(
+        self,
+        file: Union[pd.DataFrame, None, IO, str],
+        columns: Union[list, None] = None,
+    ):
+        if isinstance(file, pd.DataFrame):
+            # the lookup columns are replaced by strings, or categories when
+            # compact, so they go in a copy that shares the caller's other columns
+            return file.copy(deep=False)
+        with self.metrics.stage("read", source=str(file)) as counts:
+            frame = FileReader(
+                file, columns=columns, cache_dir=self.excel_cache_dir
+            ).data.drop_duplicates()
+            counts["rows"] = len(frame)
+        return frame
+
+    def read_columns(self, lookup_columns: list) -> Union[list, None]:
+        # with output_columns set, the other columns of a sheet are never read
+        if not self.output_columns:
+            return None
+        return list(dict.fromkeys(lookup_columns + list(self.output_columns)))
+
+    def run_threshold(self):
         print(f"Processing fuzzy match at {(self._threshold * 100):.2f}%...")
-        pool = ThreadPool(processes=1)
-        async_result = pool.apply_async(self.run, ())
-        print(async_result.get())
-        return async_result.get().drop_duplicates(subset=[self.left_on, self.right_on])
+        matches = self.run()
+        print(matches)
+        with self.metrics.stage("dedupe", threshold=self._threshold):
+            return matches.drop_duplicates(subset=self.lookup_columns)
 
     def run_iterations(self):
-        current_iteration = self.run_async()
+        # the first threshold a value appears at wins; the accumulator drops the
+        # later repeats as it goes and spills to disk past the memory budget
+        accumulator = MatchAccumulator(
+            self.de_duplicated_cols, self.memory_budget, self.spill_dir
+        )
+        accumulator.add(self.run_threshold())
 
         while True:
 
             self._threshold -= 0.01
-            next_iteration = self.run_async()
-            self.final_output.append(pd.concat([current_iteration, next_iteration]))
+            accumulator.add(self.run_threshold())
 
-            current_iteration = next_iteration
             if self._threshold <= self.minimum_threshold:
                 break
 
-        de_duplicated_col = self.left_on if self.master == "left" else self.right_on
-        self.result = pd.concat(self.final_output).drop_duplicates(
-            subset=[de_duplicated_col]
+        with self.metrics.stage("dedupe", spilled_runs=len(accumulator.runs)):
+            self.result = self.join_matches(accumulator.result())
+        print(self.result.reset_index(drop=True))
+        if self.trace:
+            self.print_chunk_timings()
+        self.get_output()
+
+    @property
+    def thresholds(self) -> list:
+        # mirrors the 0.01 steps taken by run_iterations, float drift included
+        thresholds = [self.start_threshold]
+        while True:
+            thresholds.append(thresholds[-1] - 0.01)
+            if thresholds[-1] <= self.minimum_threshold:
+                break
+        return thresholds
+
+    @staticmethod
+    def assign_thresholds(scores: pd.Series, thresholds: list) -> pd.Series:
+        # highest threshold each score clears, NaN when it clears none of them
+        ladder = np.sort(np.asarray(thresholds))[::-1]
+        position = np.searchsorted(-ladder, -scores.to_numpy(dtype=float))
+        return pd.Series(np.append(ladder, np.nan)[position], index=scores.index)
+
+    def run_single_pass(self):
+        self.result = self.join_matches(self.single_pass_matches())
+        print(self.result.reset_index(drop=True))
+        if self.trace:
+            self.print_chunk_timings()
+        self.get_output()
+
+    def pooled(self, func):
+        self.pool = self.start_pool() if self.workers > 1 else None
+        try:
+            return func()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def single_pass_matches(self) -> pd.DataFrame:
+        self._threshold = self.thresholds[-1]
+        print(f"Scoring fuzzy match once down to {(self._threshold * 100):.2f}%...")
+        return self.best_matches(self.run(self.score_match))
+
+    def best_matches(self, scored: pd.DataFrame) -> pd.DataFrame:
+        with self.metrics.stage("dedupe", rows=len(scored)):
+            scored = scored.drop_duplicates(subset=self.lookup_columns)
+            scored["similarity_index"] = self.assign_thresholds(
+                scored.pop("degree").astype(float), self.thresholds
+            )
+            return (
+                scored.dropna(subset=["similarity_index"])
+                .sort_values("similarity_index", ascending=False, kind="stable")
+                .drop_duplicates(subset=self.de_duplicated_cols)
+            )
+
+    @property
+    def lookup_columns(self) -> list:
+        # compact results carry category codes of the lookup values, not the rows
+        if self.compact:
+            return ["left_value", "right_value"]
+        return self.left_columns + self.right_columns
+
+    @property
+    def de_duplicated_cols(self) -> list:
+        if self.compact:
+            return ["left_value" if self.master == "left" else "right_value"]
+        return self.left_columns if self.master == "left" else self.right_columns
+
+    def run_stream(self, left_file: Union[IO, str], stream_rows: int):
+        # reads the left file a block at a time and appends each block's matches
+        # to the output, so only the right side and the current block stay in
+        # memory; the workers are started once and get each block's rows with
+        # its tasks
+        now = datetime.now().strftime("%d-%m-%Y-%H-%M-%S")
+        self.output_path = f"output_{now}.{self.output_format}"
+        output = BlockWriter(self.output_path, self.output_format, self.output_rows)
+        try:
+            written = self.pooled(
+                lambda: self.stream_blocks(left_file, stream_rows, output)
+            )
+        finally:
+            output.close()
+        print(f"Streamed {written:,} match(es) to {self.output_path}")
+        if self.trace:
+            self.print_chunk_timings()
+
+    def stream_blocks(
+        self, left_file: Union[IO, str], stream_rows: int, output: "BlockWriter"
+    ) -> int:
+        seen_left, best_right, written = set(), None, 0
+        for block in FileReader(left_file).chunks(stream_rows):
+            self.left_df = block.drop_duplicates()
+            self.left_shape = self.left_df.shape[0]
+            self.check_output_columns(self.right_df, self.left_df)
+            with self.metrics.stage("normalize", side="left", rows=self.left_shape):
+                self.convert_left_values()
+                if self.pool is None:
+                    self.build_left_keys()
+            self.chunk_size = self.requested_chunk_size or self.derive_chunk_size()
+            matches = self.join_matches(self.single_pass_matches())
+            if self.master == "left":
+                # a left value repeated in a later block has the same best match
+                values = pd.MultiIndex.from_frame(matches[self.left_columns])
+                matches = matches[~values.isin(seen_left)]
+                seen_left.update(values[~values.isin(seen_left)])
+                with self.metrics.stage("write", rows=len(matches)):
+                    output.write(self.output_frame(matches))
+                written += matches.shape[0]
+            else:
+                # a later block may beat an earlier winner, so keep one best row
+                # per right value and write them once the left file is exhausted
+                best_right = (
+                    pd.concat([best_right, matches])
+                    .sort_values("similarity_index", ascending=False, kind="stable")
+                    .drop_duplicates(subset=self.right_columns)
+                )
+        if best_right is not None:
+            with self.metrics.stage("write", rows=len(best_right)):
+                output.write(self.output_frame(best_right))
+            written = best_right.shape[0]
+        return written
+
+    def run_top_k(self):
+        self.result = self.top_k(self.k, self.minimum_threshold)
+        print(self.result.reset_index(drop=True))
+        if self.trace:
+            self.print_chunk_timings()
+        self.get_output()
+
+    def top_k(self, k: int, minimum_score: float = 0.0) -> pd.DataFrame:
+        # the k best-scoring right rows for every left row, best first
+        self.k, self.minimum_score = k, minimum_score
+        print(f"Finding the top {k} match(es) for each left record...")
+        return self.join_matches(self.run(self.top_k_match))
+
+    def top_k_match(
+        self, left_rows: np.ndarray, right_rows: np.ndarray, pairs=None
+    ):
+        if pairs is None:
+            left_ids = np.unique(self.left_keys.codes[left_rows])
+            right_ids = np.unique(self.right_keys.codes[right_rows])
+            matches = self.top_k_keys(left_ids, right_ids)
+        else:
+            # a blocked left key only has its own candidates to rank
+            matches = self.jaro_pairs(*self.key_pairs(pairs), self.minimum_score)
+        pairs = self.expand_matches(left_rows, right_rows, matches, pairs).sort_values(
+            ["left_row", "degree", "right_row"],
+            ascending=[True, False, True],
+            kind="stable",
+        )
+        pairs = pairs.groupby("left_row").head(self.k)
+        return (
+            self.pair_rows(pairs)
+            .rename(columns={"degree": "similarity_score"})
+            .assign(match_rank=pairs.groupby("left_row").cumcount().to_numpy() + 1)
+        )
+
+    def top_k_keys(self, left_ids: np.ndarray, right_ids: np.ndarray) -> pd.DataFrame:
+        # one batched matrix per chunk; every right key tied with the k-th best score
+        # is kept so the row-level ranking below settles ties exactly as before
+        if not len(left_ids) or not len(right_ids):
+            return self.no_keys()
+        scores = self.jaro_winkler.score_matrix(
+            self.left_keys.keys[left_ids], self.right_keys.keys[right_ids]
+        )
+        keep = scores >= self.minimum_score
+        if scores.shape[1] > self.k:
+            kth = np.partition(scores, -self.k, axis=1)[:, -self.k]
+            keep &= scores >= kth[:, None]
+        left_idx, right_idx = np.nonzero(keep)
+        return pd.DataFrame(
+            {
+                "left_key": left_ids[left_idx],
+                "right_key": right_ids[right_idx],
+                "degree": scores[left_idx, right_idx],
+            }
+        )
+
+    def run_incremental(self, cache_path: str):
+        # only left values the cache has never seen are scored; the output is then
+        # rebuilt from the cached key-level matches of every current left value
+        cache = MatchCache(cache_path, self.cache_fingerprint())
+        left_df, left_keys = self.left_df, self.left_keys
+        cache.select(left_keys.keys)
+        distinct, first_rows = np.unique(left_keys.codes, return_index=True)
+        unseen = ~np.isin(left_keys.keys[distinct], list(cache.scored_keys()))
+        print(
+            f"{unseen.sum():,} of {len(distinct):,} distinct left value(s) "
+            f"not in {cache_path}"
+        )
+        if unseen.any():
+            self.left_df = left_df.iloc[np.sort(first_rows[unseen])]
+            self.left_shape = self.left_df.shape[0]
+            self.convert_left_lookup_column()
+            self.chunk_size = self.requested_chunk_size or self.derive_chunk_size()
+            self._threshold = self.thresholds[-1]
+            matches = self.pooled(lambda: self.run(self.key_match))
+            cache.add(self.left_keys.keys, matches)
+            self.left_df, self.left_keys = left_df, left_keys
+            self.left_shape = self.left_df.shape[0]
+        matches = cache.matches()
+        left_ids = pd.Series(np.arange(len(left_keys.keys)), index=left_keys.keys)
+        right_ids = pd.Series(
+            np.arange(len(self.right_keys.keys)), index=self.right_keys.keys
+        )
+        matches = pd.DataFrame(
+            {
+                "left_key": left_ids.reindex(matches["left_key"]).to_numpy(),
+                "right_key": right_ids.reindex(matches["right_key"]).to_numpy(),
+                "degree": matches["degree"].to_numpy(),
+            }
+        )
+        pairs = self.expand_matches(
+            np.arange(self.left_shape), np.arange(self.right_df.shape[0]), matches
+        )
+        self.result = self.join_matches(self.best_matches(self.pair_rows(pairs)))
+        cache.close()
+        print(self.result.reset_index(drop=True))
+        self.get_output()
+
+    def run_dedupe(self):
+        # left row i stands for distinct key i, so each chunk of keys only has to
+        # be scored against the keys after it
+        _, first_rows = np.unique(self.right_keys.codes, return_index=True)
+        self.left_df = self.right_df.iloc[first_rows]
+        self.left_keys = self.right_keys.distinct()
+        self.left_shape = len(first_rows)
+        # distinct keys never equal one another, bar a key and itself
+        self.cascade = tuple(stage for stage in self.cascade if stage != "exact")
+        self.chunk_size = self.requested_chunk_size or self.derive_chunk_size()
+        self._threshold = self.thresholds[-1]
+        print(
+            f"Clustering {self.right_df.shape[0]:,} record(s) with "
+            f"{self.left_shape:,} distinct value(s) down to "
+            f"{(self._threshold * 100):.2f}%..."
         )
+        pairs = self.pooled(lambda: self.run(self.dedupe_match))
+        with self.metrics.stage("dedupe", pairs=len(pairs)):
+            roots = union_find(self.left_shape, pairs["left_key"], pairs["right_key"])
+            labels = roots[self.right_keys.codes]
+            sizes = np.bincount(labels, minlength=self.left_shape)[labels]
+            clustered = sizes > 1
+            self.result = (
+                self.right_df[clustered]
+                .assign(
+                    cluster_id=np.unique(labels[clustered], return_inverse=True)[1]
+                    + 1,
+                    cluster_size=sizes[clustered],
+                )
+                .sort_values("cluster_id", kind="stable")
+            )
         print(self.result.reset_index(drop=True))
+        if self.trace:
+            self.print_chunk_timings()
         self.get_output()
 
+    def dedupe_match(
+        self, left_rows: np.ndarray, right_rows: np.ndarray, pairs=None
+    ):
+        if pairs is not None:
+            left_ids, right_ids, left_idx, right_idx = self.key_pairs(pairs)
+            later = left_ids[left_idx] < right_ids[right_idx]
+            return self.score_key_pairs(
+                left_ids, right_ids, left_idx[later], right_idx[later]
+            )
+        left_ids = self.left_keys.codes[left_rows]
+        right_ids = pd.unique(self.right_keys.codes[right_rows])
+        matches = self.score_keys(left_ids, right_ids[right_ids > left_ids.min()])
+        return matches[matches["left_key"] < matches["right_key"]]
+
+    def cache_fingerprint(self) -> str:
+        # cached scores stay valid while the distinct right keys, the lowest
+        # threshold and the blocking configuration are unchanged
+        digest = hashlib.sha256()
+        digest.update("\0".join(map(str, self.right_keys.keys)).encode())
+        digest.update(repr(self.thresholds[-1]).encode())
+        digest.update(
+            repr(self.blocking_index.blockers if self.blocking_index else None).encode()
+        )
+        if self.cascade:
+            # resolved keys skip their other scores, on the master side only
+            digest.update(repr((self.cascade, self.master)).encode())
+        return digest.hexdigest()
+
+    def key_match(self, left_rows: np.ndarray, right_rows: np.ndarray, pairs=None):
+        matches = (
+            self.score_keys(
+                pd.unique(self.left_keys.codes[left_rows]),
+                pd.unique(self.right_keys.codes[right_rows]),
+            )
+            if pairs is None
+            else self.score_key_pairs(*self.key_pairs(pairs))
+        )
+        return pd.DataFrame(
+            {
+                "left_key": self.left_keys.keys[matches["left_key"]],
+                "right_key": self.right_keys.keys[matches["right_key"]],
+                "degree": matches["degree"].to_numpy(),
+            }
+        )
+
     def get_output(self):
         from datetime import datetime
 
+        writers = {
+            "xlsx": self.write_excel,
+            "csv": self.write_csv,
+            "parquet": self.write_parquet,
+        }
         now = datetime.now().strftime("%d-%m-%Y-%H-%M-%S")
-        return self.result.to_excel(f"output_{now}.xlsx", index=False)
+        self.output_path = f"output_{now}.{self.output_format}"
+        with self.metrics.stage("write", path=self.output_path, rows=len(self.result)):
+            writers[self.output_format](
+                self.output_frame(self.result), self.output_path
+            )
+        return self.output_path
 
-    def fuzzy_match(self, left_df: pd.DataFrame, right_df: pd.DataFrame):
+    def output_frame(self, frame: pd.DataFrame) -> pd.DataFrame:
+        # the requested columns plus whichever score columns the mode produced
+        if not self.output_columns:
+            return frame
+        columns = list(dict.fromkeys(self.output_columns))
+        columns += [col for col in SCORE_COLUMNS if col in frame and col not in columns]
+        return frame[columns]
+
+    @staticmethod
+    def write_excel(frame: pd.DataFrame, path: str):
+        frame.to_excel(path, index=False)
+
+    def write_csv(self, frame: pd.DataFrame, path: str):
+        # written a block of rows at a time so the text of the whole result is
+        # never held in memory at once
+        with open(path, "w", newline="", encoding="utf-8") as output:
+            for start in range(0, max(frame.shape[0], 1), self.output_rows):
+                frame.iloc[start : start + self.output_rows].to_csv(
+                    output, header=start == 0, index=False
+                )
+
+    @staticmethod
+    def write_parquet(frame: pd.DataFrame, path: str):
+        # needs pyarrow or fastparquet
+        frame.reset_index(drop=True).to_parquet(path, index=False)
+
+    def fuzzy_match(self, left_rows: np.ndarray, right_rows: np.ndarray, pairs=None):
+        return (
+            self.score_match(left_rows, right_rows, pairs)
+            .drop(columns="degree")
+            .assign(similarity_index=self._threshold)
+        )
+
+    def score_match(self, left_rows: np.ndarray, right_rows: np.ndarray, pairs=None):
+        return self.pair_rows(self.score_rows(left_rows, right_rows, pairs))
+
+    def score_rows(self, left_rows: np.ndarray, right_rows: np.ndarray, pairs=None):
+        # scores each distinct normalised key once, then fans the matches back
+        # out to every (left row, right row) pair carrying those keys; blocked
+        # rows come with their own candidate pairs and only those are scored
+        if pairs is None:
+            score = self.score_composites if self.composite else self.score_keys
+            matches = score(
+                pd.unique(self.left_codes[left_rows]),
+                pd.unique(self.right_codes[right_rows]),
+            )
+        else:
+            matches = self.score_key_pairs(*self.key_pairs(pairs))
+        return self.expand_matches(left_rows, right_rows, matches, pairs)
+
+    @property
+    def left_codes(self) -> np.ndarray:
+        return self.left_composite.codes if self.composite else self.left_keys.codes
+
+    @property
+    def right_codes(self) -> np.ndarray:
+        return self.right_composite.codes if self.composite else self.right_keys.codes
+
+    def key_pairs(self, pairs: pd.DataFrame) -> tuple:
+        # the distinct key pairs behind (left row, right row) pairs, as the two
+        # sets of key ids plus one index into each per pair
+        keys = pd.DataFrame(
+            {
+                "left_key": self.left_codes[pairs["left_row"].to_numpy()],
+                "right_key": self.right_codes[pairs["right_row"].to_numpy()],
+            }
+        ).drop_duplicates()
+        left_ids, left_idx = np.unique(keys["left_key"], return_inverse=True)
+        right_ids, right_idx = np.unique(keys["right_key"], return_inverse=True)
+        return left_ids, right_ids, left_idx.ravel(), right_idx.ravel()
+
+    def expand_matches(
+        self,
+        left_rows: np.ndarray,
+        right_rows: np.ndarray,
+        matches: pd.DataFrame,
+        pairs: Union[pd.DataFrame, None] = None,
+    ) -> pd.DataFrame:
+        if pairs is None:
+            left = pd.DataFrame(
+                {"left_row": left_rows, "left_key": self.left_codes[left_rows]}
+            )
+            right = pd.DataFrame(
+                {"right_row": right_rows, "right_key": self.right_codes[right_rows]}
+            )
+            expanded = left.merge(matches, on="left_key").merge(right, on="right_key")
+        else:
+            expanded = pairs.assign(
+                left_key=self.left_codes[pairs["left_row"].to_numpy()],
+                right_key=self.right_codes[pairs["right_row"].to_numpy()],
+            ).merge(matches, on=["left_key", "right_key"])
+        return (
+            expanded.sort_values(["left_row", "right_row"])[
+                ["left_row", "right_row", "degree"]
+            ]
+            .reset_index(drop=True)
+        )
+
+    def score_composites(
+        self,
+        left_ids: np.ndarray,
+        right_ids: np.ndarray,
+        threshold: Union[float, None] = None,
+    ) -> pd.DataFrame:
+        left_idx, right_idx = np.divmod(
+            np.arange(len(left_ids) * len(right_ids)), max(len(right_ids), 1)
+        )
+        return self.score_composite_pairs(
+            left_ids, right_ids, left_idx, right_idx, threshold
+        )
+
+    def score_composite_pairs(
+        self,
+        left_ids: np.ndarray,
+        right_ids: np.ndarray,
+        left_idx: np.ndarray,
+        right_idx: np.ndarray,
+        threshold: Union[float, None] = None,
+    ) -> pd.DataFrame:
+        # columns are scored heaviest first; a pair is dropped as soon as its
+        # score so far plus the weight of the columns left cannot reach threshold
+        threshold = (self._threshold if threshold is None else threshold) - BOUND_SLACK
+        left_tuples = self.left_composite.tuples[left_ids]
+        right_tuples = self.right_composite.tuples[right_ids]
+        total = np.zeros(len(left_idx))
+        remaining = 1.0
+        for column in np.argsort(-self.weights, kind="stable"):
+            weight = self.weights[column]
+            remaining -= weight
+            left_keys = left_tuples[left_idx, column]
+            right_keys = right_tuples[right_idx, column]
+            if self.column_scorers[column] == "exact":
+                scores = self.exact_column(column, left_keys, right_keys)
+            else:
+                bounds = JaroWinklerScorer.upper_bound(
+                    self.left_composite.columns[column].lengths[left_keys],
+                    self.right_composite.columns[column].lengths[right_keys],
+                )
+                keep = total + weight * bounds + remaining >= threshold
+                left_idx, right_idx = left_idx[keep], right_idx[keep]
+                total, left_keys, right_keys = (
+                    total[keep],
+                    left_keys[keep],
+                    right_keys[keep],
+                )
+                scores = self.jaro_column(column, left_keys, right_keys)
+            total += weight * scores
+            keep = total + remaining >= threshold
+            left_idx, right_idx, total = left_idx[keep], right_idx[keep], total[keep]
+        return pd.DataFrame(
+            {
+                "left_key": left_ids[left_idx].astype(np.int64),
+                "right_key": right_ids[right_idx].astype(np.int64),
+                "degree": total,
+            }
+        )
+
+    def exact_column(self, column: int, left_keys, right_keys) -> np.ndarray:
+        left = self.left_composite.columns[column]
+        return (
+            (self.left_in_right[column][left_keys] == right_keys)
+            & (left.lengths[left_keys] > 0)
+        ).astype(np.float64)
+
+    def jaro_column(self, column: int, left_keys, right_keys) -> np.ndarray:
+        # each distinct key pair is scored once
+        if not len(left_keys):
+            return np.zeros(0)
+        left_unique, left_idx = np.unique(left_keys, return_inverse=True)
+        right_unique, right_idx = np.unique(right_keys, return_inverse=True)
+        pairs, inverse = np.unique(
+            left_idx.astype(np.int64) * max(len(right_unique), 1) + right_idx,
+            return_inverse=True,
+        )
+        scores = self.jaro_winkler.score_pairs(
+            self.left_composite.columns[column].keys[left_unique],
+            self.right_composite.columns[column].keys[right_unique],
+            *np.divmod(pairs, max(len(right_unique), 1)),
+        )
+        return scores[inverse.ravel()]
+
+    def score_keys(
+        self,
+        left_ids: np.ndarray,
+        right_ids: np.ndarray,
+        threshold: Union[float, None] = None,
+    ) -> pd.DataFrame:
+        threshold = self._threshold if threshold is None else threshold
+        if not self.cascade:
+            return self.jaro_keys(left_ids, right_ids, threshold)
+        resolved = [self.no_keys()]
+        if "exact" in self.cascade:
+            # exact keys are joined on their hash before any pair exists, and a
+            # master-side key with an exact match needs none of its other scores
+            resolved.append(self.exact_keys(left_ids, right_ids))
+            if self.master == "left":
+                left_ids = left_ids[~np.isin(left_ids, resolved[-1]["left_key"])]
+            else:
+                right_ids = right_ids[~np.isin(right_ids, resolved[-1]["right_key"])]
+        if self.jaro_winkler.backend != "reference" and not (
+            {"length", "characters"} & set(self.cascade)
+        ):
+            # with no bound to drop pairs, a batched matrix beats per-pair scoring
+            remaining = self.jaro_keys(left_ids, right_ids, threshold)
+        else:
+            left_idx, right_idx = self.filter_pairs(
+                left_ids,
+                right_ids,
+                *np.divmod(
+                    np.arange(len(left_ids) * len(right_ids)), max(len(right_ids), 1)
+                ),
+                threshold,
+            )
+            remaining = self.jaro_pairs(
+                left_ids, right_ids, left_idx, right_idx, threshold
+            )
+        return pd.concat(resolved + [remaining], ignore_index=True)
+
+    def exact_keys(self, left_ids: np.ndarray, right_ids: np.ndarray) -> pd.DataFrame:
+        # distinct right keys are unique, so the index lookup is a hash join
+        found = pd.Index(self.right_keys.keys[right_ids]).get_indexer(
+            self.left_keys.keys[left_ids]
+        )
+        exact = (found >= 0) & (self.left_keys.lengths[left_ids] > 0)
+        return pd.DataFrame(
+            {
+                "left_key": left_ids[exact].astype(np.int64),
+                "right_key": right_ids[found[exact]].astype(np.int64),
+                "degree": np.ones(exact.sum()),
+            }
+        )
+
+    def score_key_pairs(
+        self,
+        left_ids: np.ndarray,
+        right_ids: np.ndarray,
+        left_idx: np.ndarray,
+        right_idx: np.ndarray,
+        threshold: Union[float, None] = None,
+    ) -> pd.DataFrame:
+        # scores only the pairs (left_ids[left_idx], right_ids[right_idx])
+        if self.composite:
+            return self.score_composite_pairs(
+                left_ids, right_ids, left_idx, right_idx, threshold
+            )
+        threshold = self._threshold if threshold is None else threshold
+        resolved = [self.no_keys()]
+        if "exact" in self.cascade:
+            # a master-side key with an exact match needs none of its other scores
+            exact = (
+                self.left_keys.keys[left_ids][left_idx]
+                == self.right_keys.keys[right_ids][right_idx]
+            ) & (self.left_keys.lengths[left_ids][left_idx] > 0)
+            resolved.append(
+                pd.DataFrame(
+                    {
+                        "left_key": left_ids[left_idx[exact]].astype(np.int64),
+                        "right_key": right_ids[right_idx[exact]].astype(np.int64),
+                        "degree": np.ones(exact.sum()),
+                    }
+                )
+            )
+            master_idx = left_idx if self.master == "left" else right_idx
+            keep = ~np.isin(master_idx, master_idx[exact])
+            left_idx, right_idx = left_idx[keep], right_idx[keep]
+        left_idx, right_idx = self.filter_pairs(
+            left_ids, right_ids, left_idx, right_idx, threshold
+        )
+        remaining = self.jaro_pairs(left_ids, right_ids, left_idx, right_idx, threshold)
+        return pd.concat(resolved + [remaining], ignore_index=True)
+
+    def no_keys(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "left_key": np.zeros(0, dtype=np.int64),
+                "right_key": np.zeros(0, dtype=np.int64),
+                "degree": np.zeros(0),
+            }
+        )
+
+    def filter_pairs(
+        self,
+        left_ids: np.ndarray,
+        right_ids: np.ndarray,
+        left_idx: np.ndarray,
+        right_idx: np.ndarray,
+        threshold: float,
+    ) -> tuple:
+        # upper bounds on the Jaro-Winkler score drop pairs that cannot reach the
+        # threshold: first from the key lengths, then from the shared characters
+        if "length" in self.cascade:
+            keep = (
+                JaroWinklerScorer.upper_bound(
+                    self.left_keys.lengths[left_ids][left_idx],
+                    self.right_keys.lengths[right_ids][right_idx],
+                )
+                >= threshold - BOUND_SLACK
+            )
+            left_idx, right_idx = left_idx[keep], right_idx[keep]
+        if "characters" in self.cascade:
+            bounds = JaroWinklerScorer.character_bound(
+                self.left_keys.keys[left_ids],
+                self.right_keys.keys[right_ids],
+                left_idx,
+                right_idx,
+            )
+            keep = bounds >= threshold - BOUND_SLACK
+            left_idx, right_idx = left_idx[keep], right_idx[keep]
+        return left_idx, right_idx
+
+    def jaro_pairs(
+        self,
+        left_ids: np.ndarray,
+        right_ids: np.ndarray,
+        left_idx: np.ndarray,
+        right_idx: np.ndarray,
+        threshold: float,
+    ) -> pd.DataFrame:
+        scores = self.jaro_winkler.score_pairs(
+            self.left_keys.keys[left_ids],
+            self.right_keys.keys[right_ids],
+            left_idx,
+            right_idx,
+        )
+        keep = scores >= threshold
+        return pd.DataFrame(
+            {
+                "left_key": left_ids[left_idx[keep]].astype(np.int64),
+                "right_key": right_ids[right_idx[keep]].astype(np.int64),
+                "degree": scores[keep],
+            }
+        )
+
+    def jaro_keys(
+        self, left_ids: np.ndarray, right_ids: np.ndarray, threshold: float
+    ) -> pd.DataFrame:
+        if not len(left_ids) or not len(right_ids):
+            return self.no_keys()
+        left_keys = self.left_keys.keys[left_ids]
+        right_keys = self.right_keys.keys[right_ids]
+        if self.jaro_winkler.backend != "reference":
+            matches = self.jaro_winkler.top_scores(left_keys, right_keys, threshold)
+            return pd.DataFrame(
+                {
+                    "left_key": left_ids[matches["left"]],
+                    "right_key": right_ids[matches["right"]],
+                    "degree": matches["score"].to_numpy(),
+                }
+            )
+        from fuzzy_pandas import fuzzy_merge
+
+        # keys are normalised already, so fuzzy_merge's ignore_* options are not needed
         return pd.concat(
             fuzzy_merge(
-                left_df,
-                right_df,
-                left_on=self.left_on,
-                right_on=self.right_on,
-                threshold=self._threshold,
-                ignore_case=True,
-                ignore_nonalpha=True,
+                pd.DataFrame({"key": left_keys, "left_key": left_ids}),
+                pd.DataFrame({"key": right_keys, "right_key": right_ids}),
+                on="key",
+                threshold=threshold,
                 method=method,
-            ).assign(similarity_index=self._threshold)
+                output=["1.left_key", "2.right_key", "degree"],
+            )
             for method in ["jaro"]
+        ).astype({"left_key": int, "right_key": int, "degree": float})
+
+    def join_rows(self, pairs: pd.DataFrame) -> pd.DataFrame:
+        return pd.concat(
+            [
+                self.left_df.iloc[pairs["left_row"]].reset_index(drop=True),
+                self.right_df.iloc[pairs["right_row"]].reset_index(drop=True),
+            ],
+            axis=1,
+        ).assign(degree=pairs["degree"].to_numpy())
+
+    def pair_rows(self, pairs: pd.DataFrame) -> pd.DataFrame:
+        if not self.compact:
+            return self.join_rows(pairs)
+        left_values = self.left_df[self.left_on].cat.codes.to_numpy()
+        right_values = self.right_df[self.right_on].cat.codes.to_numpy()
+        return pairs.assign(
+            left_value=left_values[pairs["left_row"]],
+            right_value=right_values[pairs["right_row"]],
         )
 
-    def run(self):
-        chunk_size = 5
+    def join_matches(self, matches: pd.DataFrame) -> pd.DataFrame:
+        # compact matches are row ids until here; only the winners get full rows
+        if not self.compact:
+            return matches
+        ids = ["left_row", "right_row", "left_value", "right_value"]
         return pd.concat(
-            self.fuzzy_match(self.left_df[chunk: (chunk + chunk_size)], self.right_df)
-            for chunk in range(0, self.left_shape, chunk_size)
-        ).reset_index(drop=True)
+            [
+                self.left_df.iloc[matches["left_row"]].reset_index(drop=True),
+                self.right_df.iloc[matches["right_row"]].reset_index(drop=True),
+                matches.drop(columns=ids).reset_index(drop=True),
+            ],
+            axis=1,
+        )
+
+    def run(self, match_func=None):
+        match_func = match_func or self.fuzzy_match
+        bounds = [
+            (chunk, chunk + self.chunk_size)
+            for chunk in range(0, self.left_shape, self.chunk_size)
+        ]
+        if self.pool is None:
+            chunks = [
+                self.match_chunk(match_func.__name__, start, stop)
+                for start, stop in bounds
+            ]
+        else:
+            starts, stops = zip(*bounds) if bounds else ((), ())
+            chunks = self.pool.map(
+                _match_chunk,
+                repeat(match_func.__name__),
+                starts,
+                stops,
+                repeat(self._threshold),
+                (
+                    (self.left_df.iloc[start:stop] for start, stop in bounds)
+                    if self.streaming
+                    else repeat(None)
+                ),
+                chunksize=max(1, len(bounds) // (self.workers * 4)),
+            )
+        frames = []
+        self.candidate_pairs = 0
+        select_seconds = match_seconds = 0.0
+        for frame, timing in chunks:
+            frames.append(frame)
+            self.candidate_pairs += timing["pairs"]
+            select_seconds += timing["select_seconds"]
+            match_seconds += timing["match_seconds"]
+            self.chunk_trace.append(timing)
+        started = time.perf_counter()
+        result = pd.concat(frames).reset_index(drop=True)
+        threshold = round(self._threshold, 4)
+        self.metrics.record("block", select_seconds, threshold=threshold)
+        self.metrics.record(
+            "score",
+            match_seconds + time.perf_counter() - started,
+            threshold=threshold,
+            candidate_pairs=self.candidate_pairs,
+            matches=len(result),
+            chunks=len(bounds),
+        )
+        self.chunk_trace.append(
+            dict(
+                threshold=self._threshold,
+                start=None,
+                rows=self.left_shape,
+                pairs=0,
+                select_seconds=0.0,
+                match_seconds=0.0,
+                concat_seconds=time.perf_counter() - started,
+            )
+        )
+        if self.blocking_index is not None:
+            total_pairs = self.left_shape * self.right_df.shape[0]
+            print(
+                f"Blocking scored {self.candidate_pairs:,} of {total_pairs:,} pairs "
+                f"({self.candidate_pairs / max(total_pairs, 1):.2%})"
+            )
+        return result
+
+    def match_chunk(self, match_func: str, start: int, stop: int) -> tuple:
+        started = time.perf_counter()
+        left_rows = np.arange(start, min(stop, self.left_shape))
+        pairs = self.candidates(left_rows)
+        right_rows = (
+            np.arange(self.right_df.shape[0])
+            if pairs is None
+            else pd.unique(pairs["right_row"])
+        )
+        selected = time.perf_counter()
+        frame = getattr(self, match_func)(left_rows, right_rows, pairs)
+        return frame, dict(
+            threshold=self._threshold,
+            start=start,
+            rows=len(left_rows),
+            pairs=len(left_rows) * len(right_rows) if pairs is None else len(pairs),
+            select_seconds=selected - started,
+            match_seconds=time.perf_counter() - selected,
+            concat_seconds=0.0,
+        )
+
+    def match_block(self, match_func: str, start: int, left_df: pd.DataFrame) -> tuple:
+        # a streamed block's rows arrive with the task, as the pool outlives blocks
+        self.left_df, self.left_shape = left_df, left_df.shape[0]
+        self.build_left_keys()
+        frame, timing = self.match_chunk(match_func, 0, self.left_shape)
+        if "left_row" in frame:
+            frame["left_row"] += start
+        return frame, dict(timing, start=start)
+
+    def chunk_timings(self) -> pd.DataFrame:
+        return pd.DataFrame(self.chunk_trace)
+
+    def print_chunk_timings(self):
+        timings = self.chunk_timings()
+        chunks = timings[timings["start"].notna()]
+        if chunks.empty:
+            return
+        # match time ~ fixed cost per fuzzy_merge call + cost per pair scored
+        if chunks["pairs"].nunique() > 1:
+            per_pair, per_call = np.polyfit(chunks["pairs"], chunks["match_seconds"], 1)
+        else:
+            per_call = 0.0
+            per_pair = chunks["match_seconds"].sum() / max(chunks["pairs"].sum(), 1)
+        print(
+            f"{len(chunks)} chunk(s) of up to {self.chunk_size} row(s): "
+            f"{chunks['select_seconds'].sum():.2f}s selecting candidates, "
+            f"{chunks['match_seconds'].sum():.2f}s matching, "
+            f"{timings['concat_seconds'].sum():.2f}s concatenating; "
+            f"~{per_call * 1e3:.2f} ms per call + {per_pair * 1e6:.3f} µs per pair"
+        )
+
+    def candidates(self, left_rows: np.ndarray) -> Union[pd.DataFrame, None]:
+        # each left row paired with the right rows its own value's blocking keys
+        # select, so a row's matches never depend on the rows chunked with it;
+        # None when unblocked, every right row being a candidate then
+        if self.blocking_index is None:
+            return None
+        codes, values = pd.factorize(self.left_df[self.left_columns[0]].iloc[left_rows])
+        numbers, positions = self.blocking_index.candidate_pairs(values)
+        counts = np.bincount(numbers, minlength=len(values))
+        offsets = np.cumsum(counts) - counts
+        sizes = counts[codes]
+        starts = np.repeat(offsets[codes] - (np.cumsum(sizes) - sizes), sizes)
+        return pd.DataFrame(
+            {
+                "left_row": np.repeat(left_rows, sizes),
+                "right_row": positions[starts + np.arange(sizes.sum())],
+            }
+        )
+
+    def blocking_report(self, sample_size: int = 100, random_state: int = 0) -> dict:
+        # scores a sample of left rows against the whole of right_df and reports
+        # the matches the blocker pruned away
+        if self.blocking_index is None:
+            raise ValueError("blocking_report requires FuzzyMatch(blocker=...)")
+        self._threshold = self.thresholds[-1]
+        sample = np.sort(
+            np.random.default_rng(random_state).choice(
+                self.left_shape, size=min(sample_size, self.left_shape), replace=False
+            )
+        )
+        pairs = self.candidates(sample)
+        full = self.score_rows(sample, np.arange(self.right_df.shape[0]))
+        blocked = self.score_rows(sample, pd.unique(pairs["right_row"]), pairs)
+        pruned = full.merge(
+            blocked[["left_row", "right_row"]], how="left", indicator=True
+        )
+        pruned = pruned[pruned["_merge"] == "left_only"].drop(columns="_merge")
+        report = {
+            "sampled_rows": len(sample),
+            "total_pairs": len(sample) * self.right_df.shape[0],
+            "candidate_pairs": len(pairs),
+            "matches_full": full.shape[0],
+            "matches_blocked": blocked.shape[0],
+            "recall": blocked.shape[0] / full.shape[0] if full.shape[0] else 1.0,
+            "pruned": self.join_rows(pruned).sort_values("degree", ascending=False),
+        }
+        print(
+            f"Blocking recall {report['recall']:.2%} on {report['sampled_rows']} rows, "
+            f"scoring {report['candidate_pairs']:,} of {report['total_pairs']:,} pairs; "
+            f"{pruned.shape[0]} match(es) pruned"
+        )
+        return report
 
     def convert_lookup_columns_to_string(self):
-        self.left_df[self.left_on] = self.left_df[self.left_on].astype(str)
-        self.right_df[self.right_on] = self.right_df[self.right_on].astype(str)
+        # the right column is converted when its MatchIndex is built
+        if self.left_df is not None:
+            self.convert_left_lookup_column()
+
+    def convert_left_lookup_column(self):
+        with self.metrics.stage("normalize", side="left", rows=self.left_shape):
+            self.normalize_left_lookup_column()
+
+    def normalize_left_lookup_column(self):
+        self.convert_left_values()
+        self.build_left_keys()
+
+    def convert_left_values(self):
+        values = self.left_df[self.left_on].astype(str)
+        self.left_df[self.left_on] = (
+            values.astype("category") if self.compact else values
+        )
+
+    def build_left_keys(self):
+        self.left_keys = NormalizedKeys(self.left_df[self.left_columns[0]])
+        if self.composite:
+            self.left_composite = CompositeKeys(
+                [self.left_keys]
+                + [NormalizedKeys(self.left_df[col]) for col in self.left_columns[1:]]
+            )
+            self.left_in_right = [
+                pd.Index(right.keys).get_indexer(left.keys)
+                for left, right in zip(
+                    self.left_composite.columns, self.right_composite.columns
+                )
+            ]
+
+
+_worker_matcher = None
+
+
+def _init_match_worker(state: dict):
+    global _worker_matcher
+    _worker_matcher = object.__new__(FuzzyMatch.__wrapped__)
+    _worker_matcher.__dict__.update(state)
+
+
+def _match_chunk(
+    match_func: str, start: int, stop: int, threshold: float, left_df=None
+) -> tuple:
+    _worker_matcher._threshold = threshold
+    if left_df is None:
+        return _worker_matcher.match_chunk(match_func, start, stop)
+    return _worker_matcher.match_block(match_func, start, left_df)
 
 
 class FileReader:
-    def __init__(self, file: Union[IO, str]):
+    def __init__(
+        self,
+        file: Union[IO, str],
+        columns: Union[list, None] = None,
+        cache_dir: Union[str, None] = None,
+    ):
         import os
 
         self.file = file
@@ -144,7 +1356,13 @@ class FileReader:
             os.path.join(os.path.join(os.path.dirname(__file__)), self.file)
         )
         self.file_extension = self.file.split(".")[-1]
-        self.data: pd.DataFrame = (
+        # columns missing from the sheet are ignored, None reads them all
+        self.columns = columns
+        self.cache_dir = cache_dir
+
+    @property
+    def data(self) -> pd.DataFrame:
+        return (
             self.read_excel
             if self.file_extension in ("xlsx", "xlsb")
             else self.read_csv
@@ -152,23 +1370,990 @@ class FileReader:
 
     @property
     def read_excel(self):
+        if self.cache_dir:
+            return self.read_cached_excel()
         return pd.read_excel(
             self.file_path,
             engine="openpyxl" if self.file_extension == "xlsx" else "pyxlsb",
+            usecols=self.usecols,
         )
 
     @property
     def read_csv(self):
         return pd.concat(
-            chunk for chunk in pd.read_csv(self.file_path, chunksize=10_000)
+            chunk
+            for chunk in pd.read_csv(
+                self.file_path, chunksize=10_000, usecols=self.usecols
+            )
+        )
+
+    @property
+    def usecols(self):
+        return None if self.columns is None else self.keep
+
+    def read_cached_excel(self) -> pd.DataFrame:
+        # the first read of each version of a workbook keeps its sheet as parquet,
+        # later reads load only the wanted columns from that file
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            print(f"pyarrow is not installed, reading {self.file} without a cache")
+            return pd.read_excel(
+                self.file_path,
+                engine="openpyxl" if self.file_extension == "xlsx" else "pyxlsb",
+                usecols=self.usecols,
+            )
+        stat = os.stat(self.file_path)
+        prefix = hashlib.sha256(self.file_path.encode()).hexdigest()[:16]
+        cache_path = os.path.join(
+            self.cache_dir, f"{prefix}-{stat.st_mtime_ns}-{stat.st_size}.parquet"
+        )
+        if os.path.exists(cache_path):
+            names = pq.ParquetFile(cache_path).schema_arrow.names
+            return pd.read_parquet(
+                cache_path,
+                engine="pyarrow",
+                columns=[name for name in names if self.keep(name)],
+            )
+        frame = pd.read_excel(
+            self.file_path,
+            engine="openpyxl" if self.file_extension == "xlsx" else "pyxlsb",
+        )
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for stale in os.listdir(self.cache_dir):
+            if stale.startswith(f"{prefix}-"):
+                os.remove(os.path.join(self.cache_dir, stale))
+        try:
+            frame.to_parquet(f"{cache_path}.tmp", engine="pyarrow", index=False)
+            os.replace(f"{cache_path}.tmp", cache_path)
+        except (ValueError, TypeError) as error:
+            # e.g. non-string headers or columns mixing numbers and text
+            print(f"{self.file} could not be cached: {error}")
+            if os.path.exists(f"{cache_path}.tmp"):
+                os.remove(f"{cache_path}.tmp")
+        return frame[[name for name in frame.columns if self.keep(name)]]
+
+    def keep(self, column) -> bool:
+        return self.columns is None or column in self.columns
+
+    def chunks(self, chunksize: int = 10_000):
+        if self.file_extension not in ("xlsx", "xlsb"):
+            yield from pd.read_csv(self.file_path, chunksize=chunksize)
+            return
+        rows = self.excel_rows()
+        header = next(rows, None)
+        while header is not None:
+            block = list(islice(rows, chunksize))
+            if not block:
+                break
+            yield pd.DataFrame(block, columns=header)
+
+    def excel_rows(self):
+        if self.file_extension == "xlsx":
+            from openpyxl import load_workbook
+
+            workbook = load_workbook(self.file_path, read_only=True, data_only=True)
+            try:
+                yield from workbook.worksheets[0].iter_rows(values_only=True)
+            finally:
+                workbook.close()
+        else:
+            from pyxlsb import open_workbook
+
+            with open_workbook(self.file_path) as workbook:
+                with workbook.get_sheet(1) as sheet:
+                    for row in sheet.rows():
+                        yield [cell.v for cell in row]
+
+
+def normalize_key(value) -> str:
+    # same normalisation fuzzy_merge applies for ignore_case + ignore_nonalpha
+    return NON_ALPHANUMERIC.sub("", str(value).lower())
+
+
+def as_columns(on: Union[str, list, None]) -> list:
+    return [on] if isinstance(on, str) else list(on or [])
+
+
+def union_find(size: int, left, right) -> np.ndarray:
+    # labels each element with the smallest element of its component: every edge
+    # hooks the larger of its two roots under the smaller, then paths are
+    # shortened until each element points straight at its root
+    parent = np.arange(size)
+    left = np.asarray(left, dtype=np.intp)
+    right = np.asarray(right, dtype=np.intp)
+    while True:
+        low = np.minimum(parent[left], parent[right])
+        high = np.maximum(parent[left], parent[right])
+        if (low == high).all():
+            return parent
+        np.minimum.at(parent, high, low)
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+
+def tokenize(value) -> list:
+    return [token for token in NON_ALPHANUMERIC.split(str(value).lower()) if token]
+
+
+class PackedKeys:
+    # strings laid end to end in one utf-8 buffer with their offsets, so a saved
+    # index maps them from disk and decodes only the keys that are looked up
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def pack(cls, keys) -> "PackedKeys":
+        encoded = [str(key).encode() for key in keys]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(key) for key in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return map(self.key, range(len(self)))
+
+    def __getitem__(self, ids):
+        if isinstance(ids, (int, np.integer)):
+            return self.key(ids)
+        ids = np.asarray(ids) if not isinstance(ids, slice) else ids
+        if isinstance(ids, slice) or ids.dtype == bool:
+            ids = np.arange(len(self))[ids]
+        keys = np.empty(len(ids), dtype=object)
+        keys[:] = [self.key(i) for i in ids]
+        return keys
+
+    def __array__(self, dtype=None, copy=None):
+        keys = self[:]
+        return keys if dtype is None else keys.astype(dtype)
+
+    def key(self, i: int) -> str:
+        return self.buffer[self.offsets[i] : self.offsets[i + 1]].tobytes().decode()
+
+    def save(self, directory: str, name: str):
+        np.save(os.path.join(directory, f"{name}.npy"), self.buffer)
+        np.save(os.path.join(directory, f"{name}_offsets.npy"), self.offsets)
+
+    @classmethod
+    def load(cls, directory: str, name: str) -> "PackedKeys":
+        return cls(
+            np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"),
+            np.load(os.path.join(directory, f"{name}_offsets.npy"), mmap_mode="r"),
+        )
+
+
+class NormalizedKeys:
+    # each distinct raw value is normalised once; rows keep an int32 code into
+    # the distinct normalised keys
+    def __init__(self, values: pd.Series):
+        raw_codes, raw_values = pd.factorize(values)
+        key_codes, keys = pd.factorize(pd.Series(raw_values).map(normalize_key))
+        self.keys = np.asarray(keys, dtype=object)
+        self.codes = key_codes.astype(np.int32)[raw_codes]
+        self.lengths = np.fromiter(map(len, self.keys), dtype=np.int32, count=len(keys))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def distinct(self) -> "NormalizedKeys":
+        # one row per distinct key, row i carrying key i
+        keys = object.__new__(type(self))
+        keys.keys, keys.lengths = self.keys, self.lengths
+        keys.codes = np.arange(len(self.keys), dtype=np.int32)
+        return keys
+
+    def save(self, directory: str):
+        PackedKeys.pack(self.keys).save(directory, "keys")
+        np.save(os.path.join(directory, "codes.npy"), self.codes)
+        np.save(os.path.join(directory, "lengths.npy"), self.lengths)
+
+    @classmethod
+    def load(cls, directory: str) -> "NormalizedKeys":
+        keys = object.__new__(cls)
+        keys.keys = PackedKeys.load(directory, "keys")
+        for name in ("codes", "lengths"):
+            path = os.path.join(directory, f"{name}.npy")
+            setattr(keys, name, np.load(path, mmap_mode="r"))
+        return keys
+
+
+class MatchCache:
+    # sqlite store of key-level scores from earlier runs, emptied whenever the
+    # fingerprint of the right list it was computed against changes
+    def __init__(self, path: str, fingerprint: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS scored (left_key TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS matches (
+                left_key TEXT, right_key TEXT, degree REAL
+            );
+            CREATE INDEX IF NOT EXISTS matches_left_key ON matches (left_key);
+            """
+        )
+        stored = self.connection.execute(
+            "SELECT value FROM meta WHERE name = 'fingerprint'"
+        ).fetchone()
+        if stored is None or stored[0] != fingerprint:
+            if stored is not None:
+                print(f"Right list changed, clearing cached matches in {path}")
+            with self.connection:
+                self.connection.execute("DELETE FROM scored")
+                self.connection.execute("DELETE FROM matches")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)",
+                    (fingerprint,),
+                )
+
+    def select(self, left_keys):
+        # the current left keys go in a temp table that the lookups below join
+        # on, so only their rows are read, through the primary key and index
+        with self.connection:
+            self.connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS current (left_key TEXT PRIMARY KEY)"
+            )
+            self.connection.execute("DELETE FROM current")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO current VALUES (?)",
+                ((str(key),) for key in left_keys),
+            )
+
+    def scored_keys(self) -> set:
+        rows = self.connection.execute(
+            "SELECT scored.left_key FROM current CROSS JOIN scored "
+            "ON scored.left_key = current.left_key"
+        )
+        return {key for (key,) in rows}
+
+    def add(self, left_keys, matches: pd.DataFrame):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO scored VALUES (?)",
+                ((str(key),) for key in left_keys),
+            )
+            self.connection.executemany(
+                "INSERT INTO matches VALUES (?, ?, ?)",
+                matches[["left_key", "right_key", "degree"]]
+                .astype({"left_key": str, "right_key": str, "degree": float})
+                .itertuples(index=False, name=None),
+            )
+
+    def matches(self) -> pd.DataFrame:
+        return pd.read_sql_query(
+            "SELECT matches.left_key, right_key, degree FROM current CROSS JOIN "
+            "matches ON matches.left_key = current.left_key",
+            self.connection,
+        )
+
+    def close(self):
+        self.connection.close()
+
+
+class BlockWriter:
+    # appends frames to one csv or parquet file as they come, output_rows at a
+    # time; parquet needs pyarrow, whose ParquetWriter adds row groups per write
+    def __init__(self, path: str, output_format: str, output_rows: int):
+        self.path = path
+        self.output_format = output_format
+        self.output_rows = output_rows
+        self.file: Union[IO, None] = None
+        self.parquet = None
+
+    def write(self, frame: pd.DataFrame):
+        frame = frame.reset_index(drop=True)
+        if self.output_format == "csv":
+            header = self.file is None
+            if header:
+                self.file = open(self.path, "w", newline="", encoding="utf-8")
+            for start in range(0, max(frame.shape[0], 1), self.output_rows):
+                frame.iloc[start : start + self.output_rows].to_csv(
+                    self.file, header=header and start == 0, index=False
+                )
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.parquet is None:
+            schema = pa.Schema.from_pandas(frame, preserve_index=False)
+            self.parquet = pq.ParquetWriter(self.path, schema)
+        table = pa.Table.from_pandas(
+            frame, schema=self.parquet.schema, preserve_index=False
+        )
+        self.parquet.write_table(table, row_group_size=self.output_rows)
+
+    def close(self):
+        for output in (self.file, self.parquet):
+            if output is not None:
+                output.close()
+
+
+class MatchAccumulator:
+    # keeps the first match added for each key, which is the best one as the
+    # thresholds only go down. Past budget bytes the kept rows are spilled as a
+    # run sorted by key hash, and result() merges the runs a block at a time
+    def __init__(
+        self,
+        keys: list,
+        budget: int,
+        spill_dir: Union[str, None] = None,
+        block_rows: int = 50_000,
+    ):
+        self.keys = list(keys)
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.block_rows = block_rows
+        self.best: Union[pd.DataFrame, None] = None
+        self.added = 0
+        self.runs: list = []
+        self.directory: Union[str, None] = None
+        # sorted hashes of the spilled keys, whose best rows are already on disk
+        self.settled = np.zeros(0, dtype=np.uint64)
+
+    def add(self, frame: pd.DataFrame):
+        if len(self.settled):
+            hashes = self.key_hash(frame)
+            found = np.searchsorted(self.settled, hashes)
+            found = found.clip(max=len(self.settled) - 1)
+            frame = frame[self.settled[found] != hashes]
+        frame = frame.assign(
+            match_order=np.arange(self.added, self.added + len(frame))
+        )
+        self.added += len(frame)
+        if self.best is not None:
+            frame = pd.concat([self.best, frame])
+        self.best = frame.drop_duplicates(subset=self.keys)
+        if self.best.memory_usage(deep=True).sum() > self.budget:
+            self.spill()
+
+    def key_hash(self, frame: pd.DataFrame) -> np.ndarray:
+        return pd.util.hash_pandas_object(frame[self.keys], index=False).to_numpy()
+
+    def spill(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="hazy_match_", dir=self.spill_dir)
+        run = self.best.assign(key_hash=self.key_hash(self.best)).sort_values(
+            "key_hash", kind="stable"
+        )
+        path = os.path.join(self.directory, f"run_{len(self.runs)}.pkl")
+        with open(path, "wb") as file:
+            for start in range(0, len(run), self.block_rows):
+                pickle.dump(
+                    run.iloc[start : start + self.block_rows],
+                    file,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+        print(f"Spilled {len(run):,} match(es) to {path}")
+        self.runs.append(path)
+        self.settled = np.union1d(self.settled, run["key_hash"].to_numpy())
+        self.best = None
+
+    @staticmethod
+    def blocks(path: str):
+        with open(path, "rb") as file:
+            while True:
+                try:
+                    yield pickle.load(file)
+                except EOFError:
+                    return
+
+    def merge(self):
+        # every run holds the rows hashing up to the smallest last hash among the
+        # current blocks, so those rows can be settled before reading further
+        readers = [self.blocks(path) for path in self.runs]
+        pending = [next(reader, None) for reader in readers]
+        while any(block is not None for block in pending):
+            bound = min(
+                block["key_hash"].iloc[-1] for block in pending if block is not None
+            )
+            taken = []
+            for i, block in enumerate(pending):
+                if block is None:
+                    continue
+                cut = np.searchsorted(block["key_hash"].to_numpy(), bound, "right")
+                taken.append(block.iloc[:cut])
+                pending[i] = block.iloc[cut:] if cut < len(block) else None
+                if pending[i] is None:
+                    pending[i] = next(readers[i], None)
+            yield (
+                pd.concat(taken)
+                .sort_values("match_order", kind="stable")
+                .drop_duplicates(subset=self.keys)
+            )
+
+    def result(self) -> pd.DataFrame:
+        # rows come back in the order they were added, as a single concat would
+        if not self.runs:
+            best = self.best if self.best is not None else pd.DataFrame()
+            return best.drop(columns="match_order", errors="ignore")
+        if self.best is not None and len(self.best):
+            self.spill()
+        try:
+            merged = pd.concat(self.merge()).sort_values("match_order", kind="stable")
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+        # a hash collision can split a key across two merged blocks
+        return merged.drop_duplicates(subset=self.keys).drop(
+            columns=["match_order", "key_hash"]
+        )
+
+
+class CompositeKeys:
+    # rows holding the same normalised key in every column share a code; row i of
+    # tuples holds the per-column key ids behind code i
+    def __init__(self, columns: list):
+        self.columns = columns
+        self.tuples, codes = np.unique(
+            np.column_stack([keys.codes for keys in columns]),
+            axis=0,
+            return_inverse=True,
+        )
+        self.codes = codes.ravel().astype(np.int32)
+
+
+class Blocker:
+    def __repr__(self):
+        params = ", ".join(
+            f"{key}={value!r}" for key, value in sorted(vars(self).items())
         )
+        return f"{type(self).__name__}({params})"
+
+    def keys(self, value: str) -> set:
+        raise NotImplementedError
+
+    def query_keys(self, value: str) -> set:
+        return self.keys(value)
+
+
+class NGramBlocker(Blocker):
+    def __init__(self, n: int = 3):
+        self.n = n
+
+    def keys(self, value: str) -> set:
+        key = normalize_key(value)
+        if len(key) <= self.n:
+            return {key}
+        return {key[i: i + self.n] for i in range(len(key) - self.n + 1)}
+
+
+class SortedTokenPrefixBlocker(Blocker):
+    def __init__(self, prefix_length: int = 4):
+        self.prefix_length = prefix_length
+
+    def keys(self, value: str) -> set:
+        return {"".join(sorted(tokenize(value)))[: self.prefix_length]}
+
+
+class PhoneticBlocker(Blocker):
+    def keys(self, value: str) -> set:
+        import jellyfish
+
+        return {jellyfish.soundex(token) for token in tokenize(value)}
+
+
+class LengthBandBlocker(Blocker):
+    def __init__(self, band_width: int = 3):
+        self.band_width = band_width
+
+    def keys(self, value: str) -> set:
+        return {len(normalize_key(value)) // self.band_width}
+
+    def query_keys(self, value: str) -> set:
+        band = len(normalize_key(value)) // self.band_width
+        return {band - 1, band, band + 1}
+
+
+class BlockingIndex:
+    def __init__(self, values: pd.Series, blockers: Union[Blocker, list]):
+        self.blockers = blockers if isinstance(blockers, list) else [blockers]
+        self.rows = len(values)
+        buckets: dict = defaultdict(list)
+        for position, value in enumerate(values):
+            for number, blocker in enumerate(self.blockers):
+                for key in blocker.keys(value):
+                    buckets[(number, key)].append(position)
+        # flattened into arrays, looked up by the sorted hashes of the bucket
+        # names, so a saved index is memory-mapped rather than unpickled
+        hashes = self.slot_hashes_of(list(buckets))
+        self.slot_numbers = np.argsort(hashes, kind="stable")
+        self.slot_hashes = hashes[self.slot_numbers]
+        self.offsets = np.cumsum([0] + [len(bucket) for bucket in buckets.values()])
+        self.positions = np.fromiter(
+            chain.from_iterable(buckets.values()),
+            dtype=np.int64,
+            count=int(self.offsets[-1]),
+        )
+
+    @staticmethod
+    def slot_hashes_of(slots: list) -> np.ndarray:
+        # (blocker number, key) pairs, keys being strings or ints
+        names = np.empty(len(slots), dtype=object)
+        names[:] = [f"{number}:{key!r}" for number, key in slots]
+        return pd.util.hash_array(names)
+
+    def candidate_pairs(self, values) -> tuple:
+        # (value number, position) for the distinct positions each value selects
+        numbers, slots = [], []
+        for value_number, value in enumerate(values):
+            for number, blocker in enumerate(self.blockers):
+                for key in blocker.query_keys(value):
+                    numbers.append(value_number)
+                    slots.append((number, key))
+        if not slots or not len(self.slot_hashes):
+            return np.zeros(0, int), np.zeros(0, int)
+        hashes = self.slot_hashes_of(slots)
+        found = np.searchsorted(self.slot_hashes, hashes)
+        found = found.clip(max=len(self.slot_hashes) - 1)
+        hit = self.slot_hashes[found] == hashes
+        slot = self.slot_numbers[found[hit]]
+        starts, sizes = self.offsets[slot], self.offsets[slot + 1] - self.offsets[slot]
+        pairs = np.unique(
+            np.repeat(np.asarray(numbers)[hit] * self.rows, sizes)
+            + self.positions[
+                np.repeat(starts - (np.cumsum(sizes) - sizes), sizes)
+                + np.arange(sizes.sum())
+            ]
+        )
+        return np.divmod(pairs, max(self.rows, 1))
+
+    def save(self, directory: str):
+        with open(os.path.join(directory, "blocking.pkl"), "wb") as file:
+            pickle.dump((self.blockers, self.rows), file)
+        for name in ("offsets", "positions", "slot_hashes", "slot_numbers"):
+            path = os.path.join(directory, f"blocking_{name}.npy")
+            np.save(path, getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: str) -> "BlockingIndex":
+        index = object.__new__(cls)
+        with open(os.path.join(directory, "blocking.pkl"), "rb") as file:
+            index.blockers, index.rows = pickle.load(file)
+        for name in ("offsets", "positions", "slot_hashes", "slot_numbers"):
+            path = os.path.join(directory, f"blocking_{name}.npy")
+            setattr(index, name, np.load(path, mmap_mode="r"))
+        return index
+
+
+class MatchIndex:
+    # the right-hand side of a match: rows, normalised keys and blocking index,
+    # optionally saved to a directory and reused while the source is unchanged
+    VERSION = 2
+
+    def __init__(
+        self,
+        right_df: pd.DataFrame,
+        right_on: Union[str, list],
+        blocker: Union[Blocker, list, None],
+        metrics: Union[MatchMetrics, None] = None,
+    ):
+        # blocking and the single-column keys use the first lookup column
+        metrics = metrics or MatchMetrics()
+        columns = as_columns(right_on)
+        self.right_df = right_df
+        with metrics.stage("normalize", side="right", rows=len(right_df)):
+            self.right_df[columns] = self.right_df[columns].astype(str)
+            self.column_keys = [NormalizedKeys(self.right_df[col]) for col in columns]
+            self.right_keys = self.column_keys[0]
+        with metrics.stage("block", rows=len(right_df)):
+            self.blocking_index = (
+                BlockingIndex(self.right_df[columns[0]], blocker) if blocker else None
+            )
+
+    @classmethod
+    def load_or_build(
+        cls,
+        directory: str,
+        source: Union[pd.DataFrame, IO, str],
+        right_on: Union[str, list],
+        blocker: Union[Blocker, list, None],
+        reader,
+        columns: Union[list, None] = None,
+        metrics: Union[MatchMetrics, None] = None,
+    ) -> "MatchIndex":
+        fingerprint = {
+            "version": cls.VERSION,
+            "source_hash": cls.source_hash(source),
+            "right_on": right_on,
+            "blocker": repr(blocker),
+        }
+        if columns is not None:
+            fingerprint["columns"] = columns
+        meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as file:
+                if json.load(file) == fingerprint:
+                    print(f"Loading match index from {directory}")
+                    with (metrics or MatchMetrics()).stage("read", source=directory):
+                        return cls.load(directory)
+        print(f"Building match index in {directory}")
+        index = cls(reader(source, columns), right_on, blocker, metrics)
+        index.save(directory, fingerprint)
+        return index
+
+    @staticmethod
+    def source_hash(source: Union[pd.DataFrame, IO, str]) -> str:
+        digest = hashlib.sha256()
+        if isinstance(source, pd.DataFrame):
+            digest.update(repr(list(source.columns)).encode())
+            digest.update(pd.util.hash_pandas_object(source).to_numpy().tobytes())
+        else:
+            with open(FileReader(source).file_path, "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    def save(self, directory: str, fingerprint: dict):
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        self.save_rows(directory)
+        self.right_keys.save(directory)
+        for number, keys in enumerate(self.column_keys[1:], start=1):
+            os.makedirs(os.path.join(directory, f"column_{number}"), exist_ok=True)
+            keys.save(os.path.join(directory, f"column_{number}"))
+        number = len(self.column_keys)
+        while os.path.isdir(os.path.join(directory, f"column_{number}")):
+            shutil.rmtree(os.path.join(directory, f"column_{number}"))
+            number += 1
+        blocking_path = os.path.join(directory, "blocking.pkl")
+        if self.blocking_index is not None:
+            self.blocking_index.save(directory)
+        elif os.path.exists(blocking_path):
+            os.remove(blocking_path)
+        # written last, so a half-written index is never mistaken for a valid one
+        with open(meta_path, "w") as file:
+            json.dump(fingerprint, file)
+
+    def save_rows(self, directory: str):
+        # an Arrow IPC file is memory-mapped on load; a pickle, read in full, is
+        # the fallback for pyarrow missing or columns Arrow cannot hold
+        for name in ("rows.arrow", "rows.pkl"):
+            if os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+        try:
+            import pyarrow as pa
+
+            table = pa.Table.from_pandas(self.right_df, preserve_index=True)
+        except (ImportError, TypeError, ValueError, NotImplementedError) as error:
+            print(f"Saving rows as a pickle, which is not memory-mapped: {error}")
+            self.right_df.to_pickle(os.path.join(directory, "rows.pkl"))
+            return
+        with pa.OSFile(os.path.join(directory, "rows.arrow"), "wb") as file:
+            with pa.ipc.new_file(file, table.schema) as writer:
+                writer.write_table(table)
+
+    @staticmethod
+    def load_rows(directory: str) -> pd.DataFrame:
+        path = os.path.join(directory, "rows.arrow")
+        if not os.path.exists(path):
+            return pd.read_pickle(os.path.join(directory, "rows.pkl"))
+        import pyarrow as pa
+
+        # the columns come back with the dtypes they were saved with; where pandas
+        # keeps strings in Arrow (its default from 3.0) they stay in the mapped file
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        return table.to_pandas()
+
+    @classmethod
+    def load(cls, directory: str) -> "MatchIndex":
+        index = object.__new__(cls)
+        index.right_df = cls.load_rows(directory)
+        index.right_keys = NormalizedKeys.load(directory)
+        index.column_keys = [index.right_keys]
+        while True:
+            path = os.path.join(directory, f"column_{len(index.column_keys)}")
+            if not os.path.isdir(path):
+                break
+            index.column_keys.append(NormalizedKeys.load(path))
+        index.blocking_index = (
+            BlockingIndex.load(directory)
+            if os.path.exists(os.path.join(directory, "blocking.pkl"))
+            else None
+        )
+        return index
+
+
+class JaroWinklerScorer:
+    # batched equivalent of the jellyfish.jaro_winkler scorer fuzzy_merge uses for
+    # method="jaro"; "reference" calls jellyfish itself, one pair at a time, and
+    # "auto" prefers rapidfuzz when it is installed, jellyfish otherwise
+    BACKENDS = ("auto", "reference", "rapidfuzz")
+
+    def __init__(self, backend: str = "auto"):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"backend must be one of {self.BACKENDS}, got {backend!r}")
+        if backend == "auto":
+            try:
+                import rapidfuzz  # noqa: F401
+
+                backend = "rapidfuzz"
+            except ImportError:
+                backend = "reference"
+        self.backend = backend
+
+    @staticmethod
+    def encode(keys) -> tuple:
+        keys = np.asarray(list(keys), dtype=str)
+        lengths = np.char.str_len(keys) if keys.size else np.zeros(0, dtype=int)
+        width = max(int(lengths.max(initial=0)), 1)
+        codes = keys.astype(f"<U{width}").view(np.uint32).reshape(len(keys), width)
+        return codes, lengths
+
+    def score_matrix(self, left_keys, right_keys) -> np.ndarray:
+        left_keys, right_keys = list(left_keys), list(right_keys)
+        if self.backend == "rapidfuzz":
+            from rapidfuzz.distance import JaroWinkler
+            from rapidfuzz.process import cdist
+
+            scores = cdist(
+                left_keys, right_keys, scorer=JaroWinkler.similarity, dtype=np.float64
+            )
+            return self.zero_empty(scores, left_keys, right_keys)
+        left_idx, right_idx = np.divmod(
+            np.arange(len(left_keys) * len(right_keys)), max(len(right_keys), 1)
+        )
+        return self.score_pairs(left_keys, right_keys, left_idx, right_idx).reshape(
+            len(left_keys), len(right_keys)
+        )
+
+    def top_scores(self, left_keys, right_keys, threshold: float) -> pd.DataFrame:
+        scores = self.score_matrix(left_keys, right_keys)
+        left_idx, right_idx = np.nonzero(scores >= threshold)
+        return pd.DataFrame(
+            {"left": left_idx, "right": right_idx, "score": scores[left_idx, right_idx]}
+        )
+
+    def score_pairs(self, left_keys, right_keys, left_idx, right_idx) -> np.ndarray:
+        left_keys, right_keys = list(left_keys), list(right_keys)
+        left_idx, right_idx = np.asarray(left_idx), np.asarray(right_idx)
+        if self.backend == "rapidfuzz":
+            from rapidfuzz.distance import JaroWinkler
+            from rapidfuzz.process import cpdist
+
+            left = [left_keys[i] for i in left_idx]
+            right = [right_keys[i] for i in right_idx]
+            scores = cpdist(
+                left, right, scorer=JaroWinkler.similarity, dtype=np.float64
+            )
+            return self.zero_empty(scores, left, right)
+        import jellyfish
+
+        return np.fromiter(
+            (
+                jellyfish.jaro_winkler_similarity(left_keys[i], right_keys[j])
+                for i, j in zip(left_idx, right_idx)
+            ),
+            dtype=np.float64,
+            count=len(left_idx),
+        )
+
+    @classmethod
+    def character_bound(
+        cls, left_keys, right_keys, left_idx, right_idx, batch_size: int = 100_000
+    ) -> np.ndarray:
+        # as upper_bound, but only characters both keys hold can be matched and the
+        # common prefix is the real one; a bound met exactly ties with the score
+        left_codes, left_lengths = cls.encode(left_keys)
+        right_codes, right_lengths = cls.encode(right_keys)
+        left_counts = cls.character_counts(left_codes, left_lengths)
+        right_counts = cls.character_counts(right_codes, right_lengths)
+        prefix_width = min(4, left_codes.shape[1], right_codes.shape[1])
+        bounds = np.zeros(len(left_idx), dtype=np.float64)
+        for start in range(0, len(left_idx), batch_size):
+            batch = slice(start, start + batch_size)
+            li, ri = left_idx[batch], right_idx[batch]
+            len1, len2 = left_lengths[li], right_lengths[ri]
+            common = np.minimum(left_counts[li], right_counts[ri]).sum(axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                common = common.astype(np.float64)
+                weight = (common / len1 + common / len2 + common / common) / 3
+            weight = np.where(common > 0, weight, 0.0)
+            same_prefix = (
+                left_codes[li, :prefix_width] == right_codes[ri, :prefix_width]
+            ) & (np.arange(prefix_width)[None, :] < np.minimum(len1, len2)[:, None])
+            prefix = np.cumprod(same_prefix, axis=1).sum(axis=1)
+            boosted = weight + prefix * 0.1 * (1.0 - weight)
+            bounds[batch] = np.where(weight > 0.7, boosted, weight)
+        return bounds
+
+    @staticmethod
+    def character_counts(codes: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        # a bin per ascii letter and digit, every other character shares the last
+        bins = np.full(codes.shape, 36, dtype=np.intp)
+        letters = (codes >= ord("a")) & (codes <= ord("z"))
+        bins[letters] = codes[letters] - ord("a")
+        digits = (codes >= ord("0")) & (codes <= ord("9"))
+        bins[digits] = codes[digits] - ord("0") + 26
+        valid = np.arange(codes.shape[1])[None, :] < lengths[:, None]
+        rows = np.broadcast_to(np.arange(len(codes))[:, None], codes.shape)
+        counts = np.zeros((len(codes), 37), dtype=np.int32)
+        np.add.at(counts, (rows[valid], bins[valid]), 1)
+        return counts
+
+    @staticmethod
+    def upper_bound(len1, len2) -> np.ndarray:
+        # best case for a pair of lengths: every character of the shorter key is
+        # matched without transpositions and the common prefix is as long as it
+        # can be; written the same way as jellyfish so equal cases tie exactly
+        len1, len2 = np.asarray(len1), np.asarray(len2)
+        common = np.minimum(len1, len2).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weight = (common / len1 + common / len2 + common / common) / 3
+        weight = np.where(common > 0, weight, 0.0)
+        boosted = weight + np.minimum(common, 4) * 0.1 * (1.0 - weight)
+        return np.where(weight > 0.7, boosted, weight)
+
+    @staticmethod
+    def zero_empty(scores: np.ndarray, left_keys: list, right_keys: list):
+        # jellyfish scores a comparison involving an empty string as 0.0
+        left_empty = np.array([not key for key in left_keys], dtype=bool)
+        right_empty = np.array([not key for key in right_keys], dtype=bool)
+        if scores.ndim == 2:
+            scores[left_empty, :] = 0.0
+            scores[:, right_empty] = 0.0
+        else:
+            scores[left_empty | right_empty] = 0.0
+        return scores
+
+
+BLOCKERS = {
+    "ngram": NGramBlocker,
+    "prefix": SortedTokenPrefixBlocker,
+    "phonetic": PhoneticBlocker,
+    "length": LengthBandBlocker,
+}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    # checked before numpy or pandas are imported, so mistakes fail fast
+    parser = argparse.ArgumentParser(
+        prog="python -m hazy_match",
+        description="Fuzzy match the lookup columns of two spreadsheets or csv files",
+        epilog="example: python -m hazy_match ListA.xlsx ListB.xlsx "
+        '--left-on "List A" --right-on "List B"',
+    )
+    parser.add_argument("left", help="left xlsx, xlsb or csv file")
+    parser.add_argument("right", nargs="?", help="right file, omitted with --dedupe")
+    parser.add_argument("--left-on", nargs="+", required=True, metavar="COLUMN")
+    parser.add_argument("--right-on", nargs="+", metavar="COLUMN")
+    parser.add_argument("--start-threshold", type=float, default=1.0)
+    parser.add_argument("--minimum-threshold", type=float, default=0.79)
+    parser.add_argument("--master", choices=["left", "right"], default="left")
+    parser.add_argument("--single-pass", action="store_true")
+    parser.add_argument("--top-k", type=int)
+    parser.add_argument("--dedupe", action="store_true")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--stream-rows", type=int, default=10_000)
+    parser.add_argument("--blocker", nargs="+", choices=list(BLOCKERS))
+    parser.add_argument(
+        "--scorer",
+        choices=["reference", "auto", "rapidfuzz"],
+        default="reference",
+    )
+    parser.add_argument("--cascade", nargs="+", choices=CASCADE_STAGES)
+    parser.add_argument("--weights", nargs="+", type=float)
+    parser.add_argument("--column-scorers", nargs="+", choices=COLUMN_SCORERS)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--memory-budget-mb", type=int, default=256)
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--index-dir")
+    parser.add_argument("--cache-path")
+    parser.add_argument("--excel-cache-dir")
+    parser.add_argument("--spill-dir", help="temporary match runs, default the tmp dir")
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        help="default xlsx, or csv with --stream",
+    )
+    parser.add_argument("--output-columns", nargs="+", metavar="COLUMN")
+    parser.add_argument("--trace", action="store_true")
+    parser.add_argument("--metrics", metavar="JSON", help="write stage metrics here")
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="WARNING",
+        help="DEBUG logs every stage event",
+    )
+    args = parser.parse_args(argv)
+
+    for path in (args.left, args.right):
+        if path is not None and not os.path.isfile(path):
+            parser.error(f"no such file: {path}")
+    if args.dedupe == (args.right is not None):
+        parser.error("give a right file, or --dedupe without one")
+    if not args.dedupe and not args.right_on:
+        parser.error("--right-on is required unless --dedupe is given")
+    if args.right_on and len(args.right_on) != len(args.left_on):
+        parser.error("--left-on and --right-on must name as many columns")
+    for name in ("weights", "column_scorers"):
+        values = getattr(args, name)
+        if values and len(values) != len(args.left_on):
+            parser.error(f"--{name.replace('_', '-')} needs one entry per column")
+    if args.stream and args.output_format == "xlsx":
+        parser.error("--stream writes csv or parquet, not xlsx")
+    if not 0 <= args.minimum_threshold <= args.start_threshold <= 1:
+        parser.error("thresholds must satisfy 0 <= minimum <= start <= 1")
+    for name in ("top_k", "workers", "chunk_size", "stream_rows", "memory_budget_mb"):
+        value = getattr(args, name)
+        if value is not None and value < 1:
+            parser.error(f"--{name.replace('_', '-')} must be at least 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format=FORMAT)
+    logger.setLevel(args.log_level)
+
+    def single(columns):
+        # one column goes in as a name, several as a list
+        return columns[0] if columns and len(columns) == 1 else columns
+
+    # FileReader resolves relative paths against this file, the CLI against the cwd
+    matcher = FuzzyMatch(
+        left_df=os.path.abspath(args.left),
+        left_on=single(args.left_on),
+        right_df=args.right and os.path.abspath(args.right),
+        right_on=single(args.right_on),
+        start_threshold=args.start_threshold,
+        minimum_threshold=args.minimum_threshold,
+        master=args.master,
+        single_pass=args.single_pass,
+        blocker=[BLOCKERS[name]() for name in args.blocker or []] or None,
+        scorer=args.scorer,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        memory_budget=args.memory_budget_mb * 1024 ** 2,
+        trace=args.trace,
+        stream=args.stream,
+        stream_rows=args.stream_rows,
+        top_k=args.top_k,
+        index_dir=args.index_dir,
+        cache_path=args.cache_path,
+        output_format=args.output_format,
+        output_columns=args.output_columns,
+        cascade=args.cascade,
+        compact=args.compact,
+        dedupe=args.dedupe,
+        weights=args.weights,
+        column_scorers=args.column_scorers,
+        excel_cache_dir=args.excel_cache_dir,
+        spill_dir=args.spill_dir,
+    )
+    if args.metrics:
+        with open(args.metrics, "w") as file:
+            json.dump(matcher.metrics.as_dict(), file, indent=2, default=str)
 
 
-FuzzyMatch(
-    left_df="ListA.xlsx",
-    left_on="List A",
-    right_df="ListB.xlsx",
-    right_on="List B",
-    start_threshold=1.0,
-)
+if __name__ == "__main__":
+    main()
 
@@ -0,0 +1,232 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import string
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+# fmt: off
+FIRST_NAMES = [
+    "James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael", "Linda",
+    "William", "Elizabeth", "David", "Barbara", "Richard", "Susan", "Joseph",
+    "Jessica", "Thomas", "Sarah", "Charles", "Karen", "Oluwaseun", "Adebayo",
+    "Chinedu", "Ngozi", "Mohammed", "Fatima", "Wei", "Mei", "Hiroshi", "Yuki",
+    "Santiago", "Lucia", "Mateo", "Sofia", "Liam", "Olivia", "Noah", "Emma",
+    "Oliver", "Amelia",
+]
+COMPANY_SUFFIXES = [
+    "Ltd", "Limited", "PLC", "Group", "Holdings", "LLP", "& Co", "Partners",
+    "Services", "Solutions", "International", "Consulting",
+]
+# fmt: on
+CONSONANTS = "bcdfghjklmnprstvwz"
+VOWELS = "aeiou"
+BLOCKERS = {
+    "none": lambda: None,
+    "ngram": lambda: _hazy_match().NGramBlocker(),
+    "prefix": lambda: _hazy_match().SortedTokenPrefixBlocker(),
+    "phonetic": lambda: _hazy_match().PhoneticBlocker(),
+    "length": lambda: _hazy_match().LengthBandBlocker(),
+}
+
+
+def _hazy_match():
+    import hazy_match
+
+    return hazy_match
+
+
+def made_up_word(rng: random.Random, syllables: int) -> str:
+    return "".join(
+        rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(syllables)
+    ).capitalize()
+
+
+def company_name(rng: random.Random) -> str:
+    words = [made_up_word(rng, rng.randint(2, 3)) for _ in range(rng.randint(1, 3))]
+    return " ".join(words + [rng.choice(COMPANY_SUFFIXES)])
+
+
+def person_name(rng: random.Random) -> str:
+    middle = f" {rng.choice(string.ascii_uppercase)}." if rng.random() < 0.3 else ""
+    return f"{rng.choice(FIRST_NAMES)}{middle} {made_up_word(rng, rng.randint(2, 4))}"
+
+
+def add_typos(name: str, rng: random.Random, edits: int) -> str:
+    # substitutions, deletions, insertions and transpositions of letters
+    chars = list(name)
+    for _ in range(edits):
+        position = rng.randrange(len(chars))
+        edit = rng.choice(["substitute", "delete", "insert", "transpose"])
+        if edit == "substitute":
+            chars[position] = rng.choice(string.ascii_lowercase)
+        elif edit == "delete" and len(chars) > 1:
+            del chars[position]
+        elif edit == "insert":
+            chars.insert(position, rng.choice(string.ascii_lowercase))
+        elif position + 1 < len(chars):
+            chars[position], chars[position + 1] = chars[position + 1], chars[position]
+    return "".join(chars)
+
+
+def generate_lists(kind: str, rows: int, typo_rate: float, seed: int):
+    # every left name has exactly one counterpart on the right, carrying one or
+    # two typos for a typo_rate share of them, so left_id == right_id is the truth
+    import pandas as pd
+
+    rng = random.Random(seed)
+    generate = company_name if kind == "company" else person_name
+    names: dict = {}
+    while len(names) < rows:
+        names.setdefault(generate(rng).lower(), None)
+    left = list(names)
+    right = [
+        add_typos(name, rng, rng.randint(1, 2)) if rng.random() < typo_rate else name
+        for name in left
+    ]
+    order = list(range(rows))
+    rng.shuffle(order)
+    left_df = pd.DataFrame({"left_name": left, "left_id": range(rows)})
+    right_df = pd.DataFrame(
+        {"right_name": [right[i] for i in order], "right_id": order}
+    )
+    return left_df, right_df
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(case: dict) -> dict:
+    # runs in a fresh process so that peak RSS belongs to this case alone
+    left_df, right_df = generate_lists(
+        case["kind"], case["rows"], case["typo_rate"], case["seed"]
+    )
+    FuzzyMatch = _hazy_match().FuzzyMatch
+    input_rss = peak_rss_mb()
+    with tempfile.TemporaryDirectory() as scratch, open(os.devnull, "w") as quiet:
+        os.chdir(scratch)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(quiet):
+            match = FuzzyMatch(
+                left_df=left_df,
+                left_on="left_name",
+                right_df=right_df,
+                right_on="right_name",
+                minimum_threshold=case["minimum_threshold"],
+                single_pass=case["single_pass"],
+                blocker=BLOCKERS[case["blocker"]](),
+                scorer=case["scorer"],
+                workers=case["workers"],
+                output_format="csv",
+                cascade=case["cascade"],
+            )
+        seconds = time.perf_counter() - started
+    timings = match.chunk_timings()
+    pairs = int(timings["pairs"].sum()) if not timings.empty else 0
+    result = match.result
+    correct = int((result["left_id"] == result["right_id"]).sum())
+    return dict(
+        case,
+        seconds=seconds,
+        match_seconds=float(timings["match_seconds"].sum()) if pairs else 0.0,
+        pairs_scored=pairs,
+        pairs_per_second=pairs / seconds if seconds else 0.0,
+        peak_rss_mb=peak_rss_mb(),
+        input_rss_mb=input_rss,
+        matches=int(result.shape[0]),
+        precision=correct / result.shape[0] if result.shape[0] else 1.0,
+        recall=correct / case["rows"],
+        stages=match.metrics.totals(),
+    )
+
+
+def run_benchmark(cases: list) -> list:
+    results = []
+    for case in cases:
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            result = executor.submit(run_case, case).result()
+        print(
+            f"{result['kind']:>7} {result['rows']:>7,} rows: "
+            f"{result['seconds']:8.2f}s, {result['pairs_per_second']:>14,.0f} pairs/s, "
+            f"peak RSS {result['peak_rss_mb']:8.1f} MB, "
+            f"precision {result['precision']:.3f}, recall {result['recall']:.3f}"
+        )
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark FuzzyMatch on synthetic name lists with planted typos"
+    )
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    parser.add_argument(
+        "--kind",
+        nargs="+",
+        choices=["company", "person"],
+        default=["company", "person"],
+    )
+    parser.add_argument("--typo-rate", type=float, default=0.3)
+    parser.add_argument("--minimum-threshold", type=float, default=0.79)
+    parser.add_argument("--sweep", action="store_true", help="threshold sweep mode")
+    parser.add_argument("--blocker", choices=list(BLOCKERS), default="ngram")
+    parser.add_argument(
+        "--scorer", choices=["reference", "auto", "rapidfuzz"], default="auto"
+    )
+    parser.add_argument(
+        "--cascade", nargs="*", default=[], choices=["exact", "length", "characters"]
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file, benchmark_<timestamp>.json")
+    args = parser.parse_args(argv)
+
+    cases = [
+        dict(
+            kind=kind,
+            rows=rows,
+            typo_rate=args.typo_rate,
+            minimum_threshold=args.minimum_threshold,
+            single_pass=not args.sweep,
+            blocker=args.blocker,
+            scorer=args.scorer,
+            workers=args.workers,
+            cascade=args.cascade,
+            seed=args.seed,
+        )
+        for kind in args.kind
+        for rows in args.rows
+    ]
+    results = run_benchmark(cases)
+    now = datetime.now().strftime("%d-%m-%Y-%H-%M-%S")
+    output = args.output or f"benchmark_{now}.json"
+    with open(output, "w") as handle:
+        json.dump(
+            dict(
+                created=datetime.now().isoformat(timespec="seconds"),
+                python=platform.python_version(),
+                machine=platform.platform(),
+                cpus=os.cpu_count(),
+                results=results,
+            ),
+            handle,
+            indent=2,
+        )
+    print(f"Saved {len(results)} result(s) to {output}")
+
+
+if __name__ == "__main__":
+    main()
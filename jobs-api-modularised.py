@@ -1,12 +1,18 @@
 from bs4 import BeautifulSoup
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 
-from threading import Thread
+from threading import Lock, Thread
+import asyncio
+import os
+import sqlite3
 import functools
 import time
 import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from urllib.parse import urlsplit
 
 
 def timer(func):
@@ -62,12 +68,332 @@ class DataFrame:
         print(JobsCounter.RELEVANT_JOBS_COUNT)
 
 
+class FetchEngine:
+    # one event loop on a daemon thread serves every scraper thread, so the global and per-host limits hold
+    # across all sites at once; the blocking fetch and parse run on the loop's thread pool
+    def __init__(self, max_connections=16, max_connections_per_host=4):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.limit = None
+        self.host_limits = {}
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_connections, thread_name_prefix='fetch'))
+        Thread(target=self.loop.run_forever, name='fetch-engine', daemon=True).start()
+
+    async def fetch(self, url_link, get, delay=None):
+        # semaphores are only touched on the loop thread, so creating them lazily here is safe
+        if self.limit is None:
+            self.limit = asyncio.Semaphore(self.max_connections)
+        host = urlsplit(url_link).netloc
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.max_connections_per_host)
+        # the host slot is taken first so a busy host never sits on global slots, and a throttled request
+        # waits out its delay here, before it takes a global slot or a worker thread
+        async with self.host_limits[host]:
+            if delay is not None:
+                await asyncio.sleep(delay(url_link))
+            async with self.limit:
+                return await self.loop.run_in_executor(None, get, url_link)
+
+    def submit(self, url_links, get, delay=None):
+        # delay(url) gives the seconds to wait before url may be requested, the wait having been reserved
+        return [asyncio.run_coroutine_threadsafe(self.fetch(url_link, get, delay), self.loop)
+                for url_link in url_links]
+
+
+class SessionPool:
+    # one keep-alive requests.Session per host with the headers set once; each session's adapter keeps up
+    # to pool_size open connections, enough for that host's share of the fetch engine
+    def __init__(self, headers, pool_size=8):
+        self.headers = headers
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.lock = Lock()
+
+    def session(self, url_link):
+        host = urlsplit(url_link).netloc
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def get(self, url_link, **kwargs):
+        return self.session(url_link).get(url_link, **kwargs)
+
+    def stats(self):
+        # per host: requests sent, connections opened, and requests that went over an open connection
+        with self.lock:
+            sessions = dict(self.sessions)
+        stats = {}
+        for host, session in sessions.items():
+            manager = session.get_adapter('https://').poolmanager
+            requests_sent, connections = 0, 0
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+            stats[host] = {'requests': requests_sent,
+                           'connections': connections,
+                           'reused': requests_sent - connections}
+        return stats
+
+
+class TokenBucket:
+    # rate tokens a second up to burst; a request takes a token or reserves the next one and sleeps until it
+    # is due, so threads queue up in order instead of polling
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.waited = 0.0
+        self.lock = Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            self.requests += 1
+            delay = max(0.0, -self.tokens / self.rate)
+            self.waited += delay
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class RateLimiter:
+    # one token bucket per host, shared by every scraper thread and the fetch engine's workers; limits maps
+    # a host to (requests per second, burst), hosts not listed get default, and None leaves a host unthrottled
+    def __init__(self, limits, default=None):
+        self.limits = limits
+        self.default = default
+        self.buckets = {}
+        self.lock = Lock()
+
+    def bucket(self, url_link):
+        host = urlsplit(url_link).netloc
+        with self.lock:
+            if host not in self.buckets:
+                limit = self.limits.get(host, self.default)
+                self.buckets[host] = TokenBucket(*limit) if limit is not None else None
+            return self.buckets[host]
+
+    def acquire(self, url_link):
+        bucket = self.bucket(url_link)
+        if bucket is not None:
+            bucket.acquire()
+
+    def reserve(self, url_link):
+        bucket = self.bucket(url_link)
+        return bucket.reserve() if bucket is not None else 0.0
+
+    def stats(self):
+        with self.lock:
+            buckets = dict(self.buckets)
+        return {host: {'requests': bucket.requests, 'waited_seconds': round(bucket.waited, 3)}
+                for host, bucket in buckets.items() if bucket is not None}
+
+
+class ResponseCache:
+    # sqlite store of page bodies by url, shared by all threads through one connection. Entries younger than
+    # the ttl are served as they are, older ones are revalidated with their ETag / Last-Modified, and the
+    # least recently used are evicted once the bodies pass max_bytes
+    def __init__(self, path, ttl=24 * 60 * 60, max_bytes=200 * 1024 ** 2):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY, body TEXT, etag TEXT, last_modified TEXT,
+                fetched_at REAL, used_at REAL, size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+            """
+        )
+
+    def get(self, url_link):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT body, etag, last_modified, fetched_at FROM responses WHERE url = ?", (url_link,)
+            ).fetchone()
+            if row is not None:
+                with self.connection:
+                    self.connection.execute("UPDATE responses SET used_at = ? WHERE url = ?",
+                                            (time.time(), url_link))
+        return row
+
+    def store(self, url_link, body, etag, last_modified):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (url_link, body, etag, last_modified, now, now, len(body.encode())))
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                self.evict(total)
+
+    def evict(self, total):
+        rows = self.connection.execute("SELECT url, size FROM responses ORDER BY used_at")
+        evicted = []
+        for url_link, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((url_link,))
+            total -= size
+        self.connection.executemany("DELETE FROM responses WHERE url = ?", evicted)
+
+    def count(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+
+    def refresh(self, url_link):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE responses SET fetched_at = ? WHERE url = ?", (time.time(), url_link))
+
+    def fresh(self, url_link, max_age=None):
+        # whether fetch would answer from the cache without going to the site
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            row = self.connection.execute("SELECT fetched_at FROM responses WHERE url = ?", (url_link,)).fetchone()
+        return row is not None and time.time() - row[0] < max_age
+
+    def fetch(self, url_link, get, max_age=None):
+        # max_age=0 always goes to the site, which still answers 304 when the cached copy is current
+        max_age = self.ttl if max_age is None else max_age
+        cached = self.get(url_link)
+        if cached is not None and time.time() - cached[3] < max_age:
+            self.count('hits')
+            return cached[0]
+        headers = {}
+        if cached is not None and cached[1]:
+            headers['If-None-Match'] = cached[1]
+        if cached is not None and cached[2]:
+            headers['If-Modified-Since'] = cached[2]
+        response = get(url_link, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            self.count('revalidated')
+            self.refresh(url_link)
+            return cached[0]
+        self.count('misses')
+        if response.ok:
+            self.store(url_link, response.text, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return response.text
+
+
 class MakeSoup:
     HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
                              'Chrome/79.0.3945.117 Safari/537.36'}
-
-    def soup(self, url_link):
-        return BeautifulSoup(requests.get(url_link, headers=self.HEADERS).text, 'lxml')
+    MAX_CONNECTIONS = 16
+    MAX_CONNECTIONS_PER_HOST = 4
+    POOL_SIZE = 8
+    # detail pages are served from here for CACHE_TTL seconds; CACHE_PATH = None turns the cache off. It sits
+    # next to this file, wherever the scraper is started from
+    CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'http_cache.sqlite3')
+    CACHE_TTL = 24 * 60 * 60
+    CACHE_MAX_BYTES = 200 * 1024 ** 2
+    # (requests per second, burst) by host; only requests that reach the site take a token, not cache hits
+    RATE_LIMITS = {'www.jobserve.com': (0.5, 1),
+                   'www.indeed.co.uk': (2, 4),
+                   'www.indeed.com': (2, 4),
+                   'www.reed.co.uk': (5, 10),
+                   'www.totaljobs.com': (5, 10),
+                   'www.cwjobs.co.uk': (5, 10),
+                   'www.cv-library.co.uk': (3, 6)}
+    DEFAULT_RATE_LIMIT = (5, 10)
+    _engine = None
+    _sessions = None
+    _cache = None
+    _limiter = None
+    _engine_lock = Lock()
+
+    def get(self, url_link, **kwargs):
+        self.rate_limiter().acquire(url_link)
+        return self.session_pool().get(url_link, **kwargs)
+
+    def soup(self, url_link, max_age=None, get=None):
+        # listing pages pass max_age=0 so a search never sees yesterday's results; the fetch engine passes
+        # a get that takes no token, as it has reserved one already
+        get = get or self.get
+        cache = self.response_cache()
+        if cache is None:
+            return BeautifulSoup(get(url_link).text, 'lxml')
+        return BeautifulSoup(cache.fetch(url_link, get, max_age), 'lxml')
+
+    def request_delay(self, url_link, max_age=None):
+        # reserves a token for a request that will reach the site; a cache hit needs none
+        cache = self.response_cache()
+        if cache is not None and cache.fresh(url_link, max_age):
+            return 0.0
+        return self.rate_limiter().reserve(url_link)
+
+    def engine_submit(self, url_links, max_age):
+        get = functools.partial(self.soup, max_age=max_age, get=self.session_pool().get)
+        delay = functools.partial(self.request_delay, max_age=max_age)
+        return self.fetch_engine().submit(url_links, get, delay)
+
+    @classmethod
+    def rate_limiter(cls):
+        with cls._engine_lock:
+            if MakeSoup._limiter is None:
+                MakeSoup._limiter = RateLimiter(cls.RATE_LIMITS, cls.DEFAULT_RATE_LIMIT)
+        return MakeSoup._limiter
+
+    @classmethod
+    def rate_limit_stats(cls):
+        return cls.rate_limiter().stats()
+
+    @classmethod
+    def response_cache(cls):
+        with cls._engine_lock:
+            if MakeSoup._cache is None and cls.CACHE_PATH is not None:
+                MakeSoup._cache = ResponseCache(cls.CACHE_PATH, cls.CACHE_TTL, cls.CACHE_MAX_BYTES)
+        return MakeSoup._cache
+
+    @classmethod
+    def session_pool(cls):
+        with cls._engine_lock:
+            if MakeSoup._sessions is None:
+                MakeSoup._sessions = SessionPool(cls.HEADERS, cls.POOL_SIZE)
+        return MakeSoup._sessions
+
+    @classmethod
+    def connection_stats(cls):
+        return cls.session_pool().stats()
+
+    @classmethod
+    def fetch_engine(cls):
+        with cls._engine_lock:
+            if MakeSoup._engine is None:
+                MakeSoup._engine = FetchEngine(cls.MAX_CONNECTIONS, cls.MAX_CONNECTIONS_PER_HOST)
+        return MakeSoup._engine
+
+    def soups(self, url_links, max_age=None):
+        # yields (url, soup) pairs in the order the pages arrive, not the order given
+        url_links = list(url_links)
+        futures = dict(zip(self.engine_submit(url_links, max_age), url_links))
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def page_soups(self, url_links):
+        # the result pages of a search, fetched together within the engine's limits and returned in page order;
+        # listings are always fetched fresh
+        futures = self.engine_submit(list(url_links), max_age=0)
+        return [future.result() for future in futures]
 
 
 class WriteToDisk:
@@ -135,7 +461,7 @@ class URLS:
                                                                             attrs_dict,
                                                                             url_pagination)
         urls = (self.JOBSERVE_DYNAMIC_URL.format(page) for page in range(1, num_of_pages + 1))
-        soups = (MakeSoup().soup(url) for url in urls)
+        soups = MakeSoup().page_soups(urls)
         hrefs = (soup.find_all('div', attrs={'class': 'jobListHeaderPanel'}) for soup in soups)
         flat_hrefs_list = list(itertools.chain.from_iterable(hrefs))
         print([self.JOBSERVE_BASE_URL + div.a['href'] for div in flat_hrefs_list])
@@ -153,7 +479,7 @@ class URLS:
         urls = [self.INDEED_DYNAMIC_URL.format(keyword, starting_salary, page) for page in
                 range(0, (num_of_pages * 50), 50)]
         print(urls)
-        soups = [MakeSoup().soup(url) for url in urls]
+        soups = MakeSoup().page_soups(urls)
         hrefs = [soup.find_all('div', attrs={'class': 'title'}) for soup in soups]
         flat_hrefs_list = list(itertools.chain.from_iterable(hrefs))
         print([self.INDEED_BASE_URL + div.a['href'] for div in flat_hrefs_list])
@@ -164,7 +490,7 @@ class URLS:
         num_of_pages = PageCounter(keyword, starting_salary).get_reed_page_count(results_per_page)
         urls = (self.REED_DYNAMIC_URL.format(keyword, page, starting_salary)
                 for page in range(1, num_of_pages + 1))
-        soups = (MakeSoup().soup(url) for url in urls)
+        soups = MakeSoup().page_soups(urls)
         hrefs = (soup.find_all('h3', attrs={'class': 'title'}) for soup in soups)
         flat_hrefs_list = list(itertools.chain.from_iterable(hrefs))
         return [self.REED_BASE_URL + div.a['href'] for div in flat_hrefs_list]
@@ -178,7 +504,7 @@ class URLS:
                                                                             url_pagination)
         urls = (dynamic_url.format(keyword, starting_salary, page_no)
                 for page_no in range(1, num_of_pages + 1))
-        total_soups = (MakeSoup().soup(link) for link in urls)
+        total_soups = MakeSoup().page_soups(urls)
         hrefs = (total_soup.find_all('div', {'class': 'job-title'}) for total_soup in total_soups)
         flat_hrefs_list = list(itertools.chain.from_iterable(hrefs))
         return [div.a['href'] for div in flat_hrefs_list]
@@ -191,7 +517,7 @@ class PageCounter(QueryParameters, MakeSoup, URLS):
 
     @timer
     def get_page_count(self, results_per_page, tag_name, attrs_dict, url_pagination=None):
-        soup = self.soup(self.get_pagination_url(url_pagination, self.keyword, self.starting_salary))
+        soup = self.soup(self.get_pagination_url(url_pagination, self.keyword, self.starting_salary), max_age=0)
         results_count = int(soup.find(tag_name, attrs=attrs_dict).span.text.strip().replace(',', ''))
         if results_count:
             if results_count < results_per_page:
@@ -201,7 +527,7 @@ class PageCounter(QueryParameters, MakeSoup, URLS):
 
     @timer
     def get_indeed_page_count(self, results_per_page, tag_name, attrs_dict):
-        soup = self.soup(self.get_pagination_url(self.INDEED_URL_PAGES, self.keyword, self.starting_salary))
+        soup = self.soup(self.get_pagination_url(self.INDEED_URL_PAGES, self.keyword, self.starting_salary), max_age=0)
         results_count = int(soup.find(tag_name, attrs=attrs_dict).text.strip().split(' ')[-2].replace(',', ''))
         if results_count:
             if results_count < results_per_page:
@@ -213,7 +539,8 @@ class PageCounter(QueryParameters, MakeSoup, URLS):
 
     @timer
     def get_reed_page_count(self, results_per_page):
-        reed_soup = MakeSoup().soup(self.get_pagination_url(self.REED_URL_PAGES, self.keyword, self.starting_salary))
+        reed_soup = MakeSoup().soup(self.get_pagination_url(self.REED_URL_PAGES, self.keyword, self.starting_salary),
+                                    max_age=0)
         results_count = int(reed_soup.find('span', attrs={'class': 'count'}).text.strip().replace(',', ''))
         if results_count:
             if results_count < results_per_page:
@@ -225,7 +552,7 @@ class PageCounter(QueryParameters, MakeSoup, URLS):
 
     @timer
     def get_total_cw_jobs_count(self, results_per_page, pagination_url):
-        soup = MakeSoup().soup(self.get_pagination_url(pagination_url, self.keyword, self.starting_salary))
+        soup = MakeSoup().soup(self.get_pagination_url(pagination_url, self.keyword, self.starting_salary), max_age=0)
         results_count = int(soup.find('div', attrs={'class': 'page-title'}).span.text.strip().replace(',', ''))
         if results_count:
             if results_count < results_per_page:
@@ -258,6 +585,7 @@ class JobServeJobs(Interfaces, PageCounter):
                                                                  keyword=self.keyword,
                                                                  starting_salary=self.starting_salary)
         self.get_jobserve_jobs()
+        print('Rate limit waits by host:', self.rate_limit_stats())
         self.TOTAL_JOB_COUNT = len(self.jobserve_job_links)
         self.to_excel(df=self.df, keyword=self.keyword)
         self.get_job_counts(total_count=self.TOTAL_JOB_COUNT,
@@ -265,9 +593,7 @@ class JobServeJobs(Interfaces, PageCounter):
 
     @timer
     def get_jobserve_jobs(self):
-        for job_link in self.jobserve_job_links[:3]:
-            soup = self.soup(job_link)
-            time.sleep(2)
+        for job_link, soup in self.soups(self.jobserve_job_links[:3]):
             description = soup.find('div', {'class': "md_skills"}).text
             title = soup.find('h1', {'id': 'positiontitle'}).text.strip()
             salary_tag = soup.find('span', {'id': "md_rate"})
@@ -307,9 +633,8 @@ class IndeedJobs(Interfaces, PageCounter):
 
     @timer
     def get_indeed_jobs(self):
-        for job_link in self.indeed_job_links:
+        for job_link, soup in self.soups(self.indeed_job_links):
             location, job_type, salary, advertiser = (None,) * 4
-            soup = self.soup(job_link)
             description = soup.find('div', {'id': "jobDescriptionText", 'class': "jobsearch-jobDescriptionText"}).text
             title = soup.find('div', {'class': 'jobsearch-JobInfoHeader-title-container'}).text
             location_type_salary_container = \
@@ -349,8 +674,7 @@ class ReedJobs(Interfaces, PageCounter):
 
     @timer
     def get_reed_jobs(self):
-        for job_link in self.reed_job_links:
-            soup = self.soup(job_link)
+        for job_link, soup in self.soups(self.reed_job_links):
             description = soup.find('span', {'itemprop': "description"}).text
             title = soup.find('h1').text
             salary_tag = soup.find('span', {'data-qa': "salaryLbl"})
@@ -397,8 +721,7 @@ class TotalCWJobs(Interfaces, PageCounter):
 
     @timer
     def get_jobs(self, job_links):
-        for job_link in job_links:
-            soup = self.soup(job_link)
+        for job_link, soup in self.soups(job_links):
             description = soup.find('div', {'class': "job-description"}).text
             title = soup.find('h1').text.strip()
             salary_tag = soup.find('li', {'class': "salary icon"})
@@ -454,6 +777,10 @@ class MainWrapper(ReedJobs, IndeedJobs, TotalCWJobs):
         self.to_excel(df=self.df, keyword=self.keyword)
         self.get_job_counts(total_count=self.TOTAL_JOB_COUNT,
                             relevant_count=JobsCounter.RELEVANT_JOBS_COUNT)
+        print('Connection reuse by host:', self.connection_stats())
+        print('Rate limit waits by host:', self.rate_limit_stats())
+        if self.response_cache() is not None:
+            print('Response cache:', self.response_cache().stats)
 
 
 if __name__ == "__main__":
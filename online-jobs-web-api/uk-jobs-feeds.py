@@ -3,7 +3,6 @@ from datetime import datetime
 import pandas as pd
 from threading import Thread
 from multiprocessing.pool import ThreadPool
-import time
 import itertools
 
 from models import db_connect, create_table
@@ -23,6 +22,7 @@ class JobServeJobs(Interfaces, PageCounter):
                                                                  contract_only=self.contract_only,
                                                                  starting_salary=self.starting_salary)
         self.get_jobserve_jobs()
+        print('Rate limit waits by host:', self.rate_limit_stats())
         self.TOTAL_JOB_COUNT = len(self.jobserve_job_links)
         self.to_excel(df=self.df, keyword=self.keyword)
         self.get_job_counts(total_count=self.TOTAL_JOB_COUNT,
@@ -30,9 +30,7 @@ class JobServeJobs(Interfaces, PageCounter):
 
     @timer
     def get_jobserve_jobs(self):
-        for job_link in self.jobserve_job_links[:3]:
-            soup = self.soup(job_link)
-            time.sleep(2)
+        for job_link, soup in self.soups(self.jobserve_job_links[:3]):
             description = soup.find('div', {'class': "md_skills"}).text
             title = soup.find('h1', {'id': 'positiontitle'}).text.strip()
             salary_tag = soup.find('span', {'id': "md_rate"})
@@ -77,9 +75,8 @@ class IndeedUKJobs(Interfaces, PageCounter):
 
     @timer
     def get_indeed_uk_jobs(self, job_links):
-        for job_link in job_links:
+        for job_link, soup in self.soups(job_links):
             location, job_type, salary, advertiser = (None,) * 4
-            soup = self.soup(job_link)
             description = soup.find('div', {'id': "jobDescriptionText", 'class': "jobsearch-jobDescriptionText"}).text
             title = soup.find('div', {'class': 'jobsearch-JobInfoHeader-title-container'}).text
             location_type_salary_container = \
@@ -130,8 +127,7 @@ class ReedJobs(Interfaces, PageCounter):
 
     @timer
     def get_reed_jobs(self):
-        for job_link in self.reed_job_links:
-            soup = self.soup(job_link)
+        for job_link, soup in self.soups(self.reed_job_links):
             description = soup.find('span', {'itemprop': "description"}).text
             title = soup.find('h1').text
             salary_tag = soup.find('span', {'data-qa': "salaryLbl"})
@@ -192,8 +188,7 @@ class TotalCWJobs(Interfaces, PageCounter):
 
     @timer
     def get_jobs(self, job_links):
-        for job_link in job_links:
-            soup = self.soup(job_link)
+        for job_link, soup in self.soups(job_links):
             description = self.find('div', {'class': "job-description"}, soup).text
             title = soup.find('h1').text.strip()
             salary_tag = self.find('li', {'class': "salary icon"}, soup)
@@ -248,8 +243,7 @@ class CVLibraryJobs(Interfaces, PageCounter):
 
     @timer
     def get_cvlibrary_jobs(self, job_links):
-        for job_link in job_links:
-            soup = self.soup(job_link)
+        for job_link, soup in self.soups(job_links):
             title_tag = soup.find('h1', {'class': 'job__title'})
             title = title_tag.text.strip().splitlines()[0] if title_tag is not None else None
             description_tag = soup.find('div', {'class': 'job__description'})
@@ -328,6 +322,10 @@ class MainWrapper(ReedJobs,
         self.get_job_counts(total_count=self.TOTAL_JOB_COUNT,
                             relevant_count=JobsCounter.RELEVANT_JOBS_COUNT,
                             job_count_by_site=job_count_by_site)
+        print('Connection reuse by host:', self.connection_stats())
+        print('Rate limit waits by host:', self.rate_limit_stats())
+        if self.response_cache() is not None:
+            print('Response cache:', self.response_cache().stats)
 
 
 if __name__ == "__main__":
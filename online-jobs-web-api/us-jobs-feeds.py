@@ -65,10 +65,9 @@ class IndeedUSJobs(Interfaces, PageCounter):
         self.out_df.to_sql(name=self.db_format, con=self.engine, index=False)
 
     def get_indeed_us_jobs(self, job_links):
-        for job_link in job_links:
+        for job_link, soup in self.soups(job_links):
             job_data = {}
             location, job_type, salary, advertiser = (None,) * 4
-            soup = self.soup(job_link)
             description = soup.find('div', {'id': "jobDescriptionText", 'class': "jobsearch-jobDescriptionText"}).text
             title = soup.find('div', {'class': 'jobsearch-JobInfoHeader-title-container'}).text
             advertiser_tag = soup.find('div', {'class': 'icl-u-lg-mr--sm icl-u-xs-mr--xs'})